@@ -0,0 +1,193 @@
+"""Microbenchmarks of the bot's pure hot functions, with a JSON baseline per commit.
+
+Covers prompt assembly (ChatGPT._generate_prompt_messages), prompt token
+estimation (ChatGPT._fit_dialog_messages, count_dialog_message_tokens), vision image preparation (image_utils.prepare_image:
+downscale, JPEG re-encode, base64), the /mode and /settings menus,
+split_text_into_chunks and the /balance cost computation.
+Dialogs are synthetic, from 1 to 500 turns; images are noisy JPEGs of Telegram's photo sizes.
+
+Each run saves its results to benchmarks/results/<commit>.json. Compare two
+commits with:
+    git checkout HEAD~1 && python benchmarks/bench_hot_paths.py
+    git checkout -    && python benchmarks/bench_hot_paths.py --compare HEAD~1
+
+Usage (from the repo root, with config/config.yml and config/config.env in place):
+    python benchmarks/bench_hot_paths.py [--filter prompt] [--compare <commit or file>] [--output <file>]
+"""
+import argparse
+import asyncio
+import json
+import platform
+import statistics
+import subprocess
+import sys
+import timeit
+from datetime import datetime
+from io import BytesIO
+from pathlib import Path
+
+from PIL import Image
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+RESULTS_DIR = ROOT_DIR / "benchmarks" / "results"
+
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+
+import config  # noqa: E402
+import database  # noqa: E402
+import image_utils  # noqa: E402
+import openai_utils  # noqa: E402
+import bot  # noqa: E402
+
+
+MODEL = "gpt-4o-mini"
+DIALOG_TURNS = [1, 10, 100, 500]
+IMAGE_SIZES = [(800, 600), (1280, 960), (2560, 1920)]  # Telegram's photo sizes
+N_REPEATS = 5  # each repeat runs for ~0.2 s (timeit autorange)
+
+
+def get_commit(rev="HEAD"):
+    try:
+        return subprocess.check_output(
+            ["git", "rev-parse", "--short", rev], cwd=ROOT_DIR, text=True, stderr=subprocess.DEVNULL
+        ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def generate_dialog(n_turns, image_every=0):
+    """Synthetic dialog; every `image_every`-th user message references a stored image"""
+    dialog_messages = []
+    for i in range(n_turns):
+        text = f"Question {i}: how do I make this function faster without changing its output? " * 3
+        user = text
+        if image_every and i % image_every == 0:
+            user = [
+                {"type": "text", "text": text},
+                {"type": "image", "image_id": f"image{i}", "width": 1024, "height": 768},
+            ]
+        dialog_messages.append({
+            "user": user,
+            "bot": f"Answer {i}: profile it first, then cache what repeats and batch the rest. " * 8,
+        })
+    return dialog_messages
+
+
+def bench(fn):
+    """Per-call time of fn in microseconds: median and min of N_REPEATS timeit runs"""
+    timer = timeit.Timer(fn)
+    number, _ = timer.autorange()
+    times = [t / number * 1e6 for t in timer.repeat(repeat=N_REPEATS, number=number)]
+    return {"median_us": statistics.median(times), "min_us": min(times), "number": number}
+
+
+def get_cases():
+    chatgpt = openai_utils.ChatGPT(model=MODEL)
+
+    for n_turns in DIALOG_TURNS:
+        dialog_messages = generate_dialog(n_turns)
+        yield f"generate_prompt_messages[turns={n_turns}]", lambda dialog_messages=dialog_messages: (
+            chatgpt._generate_prompt_messages("Final question?", dialog_messages, "assistant")
+        )
+
+    dialog_messages = generate_dialog(100, image_every=10)
+    dialog_images = {f"image{i}": "A" * 100_000 for i in range(0, 100, 10)}  # ~75 KB images, base64
+    yield "generate_prompt_messages[turns=100,images=10]", lambda: (
+        chatgpt._generate_prompt_messages("Final question?", dialog_messages, "assistant", dialog_images=dialog_images)
+    )
+
+    for n_turns in DIALOG_TURNS:
+        dialog_messages = generate_dialog(n_turns)
+        for dialog_message in dialog_messages:  # stored turns carry their token count
+            dialog_message["n_tokens"] = openai_utils.count_dialog_message_tokens(dialog_message, MODEL)
+        yield f"fit_dialog_messages[turns={n_turns}]", lambda dialog_messages=dialog_messages: (
+            chatgpt._fit_dialog_messages("Final question?", dialog_messages, "assistant")
+        )
+
+    dialog_message = {
+        "user": "Here is a fairly long question with some code in it. " * 10,
+        "bot": "Here is a fairly long answer with code and explanations. " * 50,
+    }
+    yield "count_dialog_message_tokens", lambda: openai_utils.count_dialog_message_tokens(dialog_message, MODEL)
+
+    for width, height in IMAGE_SIZES:
+        buf = BytesIO()
+        Image.effect_noise((width, height), 64).convert("RGB").save(buf, format="JPEG", quality=90)
+        image_data = buf.getvalue()
+        yield f"prepare_image[{width}x{height}]", lambda image_data=image_data: (
+            image_utils.prepare_image(image_data, MODEL)
+        )
+
+    n_pages = -(-len(config.chat_modes) // config.n_chat_modes_per_page)
+    for page_index in sorted({0, n_pages - 1}):
+        yield f"get_chat_mode_menu[page={page_index}]", lambda page_index=page_index: bot.get_chat_mode_menu(page_index)
+
+    # get_settings_menu reads the current model, so it runs against the in-memory storage
+    loop = asyncio.new_event_loop()
+    bot.db = database.Database(backend="memory")
+    loop.run_until_complete(bot.db.add_new_user(1, 1))
+    yield "get_settings_menu", lambda: loop.run_until_complete(bot.get_settings_menu(1))
+
+    for n_chars in [4096, 100_000]:
+        text = "x" * n_chars
+        yield f"split_text_into_chunks[{n_chars}chars]", lambda text=text: list(bot.split_text_into_chunks(text, 4096))
+
+    usage = {
+        "n_used_tokens": {
+            model: {"n_input_tokens": 1_234_567, "n_output_tokens": 345_678}
+            for model in config.models["available_text_models"]
+        },
+        "n_generated_images": 42,
+        "n_transcribed_seconds": 1234.5,
+    }
+    yield f"get_balance_text[models={len(usage['n_used_tokens'])}]", lambda: bot.get_balance_text(usage)
+
+
+def load_results(path_or_commit):
+    path = Path(path_or_commit)
+    if not path.exists():
+        path = RESULTS_DIR / f"{get_commit(path_or_commit) or path_or_commit}.json"
+    with open(path) as f:
+        return json.load(f)
+
+
+def main(args):
+    openai_utils.prewarm_encodings()
+
+    baseline = load_results(args.compare)["results"] if args.compare else {}
+
+    results = {}
+    header = f"{'benchmark':<48} {'median, us':>12} {'min, us':>12}"
+    if baseline:
+        header += f" {'baseline, us':>13} {'change':>8}"
+    print(header)
+    for name, fn in get_cases():
+        if args.filter and args.filter not in name:
+            continue
+
+        results[name] = bench(fn)
+        line = f"{name:<48} {results[name]['median_us']:>12.1f} {results[name]['min_us']:>12.1f}"
+        if name in baseline:
+            old = baseline[name]["median_us"]
+            line += f" {old:>13.1f} {(results[name]['median_us'] - old) / old * 100:>+7.1f}%"
+        print(line)
+
+    output = Path(args.output) if args.output else RESULTS_DIR / f"{get_commit() or 'unknown'}.json"
+    output.parent.mkdir(parents=True, exist_ok=True)
+    with open(output, "w") as f:
+        json.dump({
+            "commit": get_commit(),
+            "created": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+            "results": results,
+        }, f, indent=2)
+    print(f"\nsaved to {output}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--filter", help="run only benchmarks whose name contains this string")
+    parser.add_argument("--compare", help="baseline: a results file or a commit with saved results")
+    parser.add_argument("--output", help=f"where to save results (default: {RESULTS_DIR.relative_to(ROOT_DIR)}/<commit>.json)")
+    main(parser.parse_args())
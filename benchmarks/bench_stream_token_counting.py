@@ -0,0 +1,63 @@
+"""Per-chunk cost of token counting in the streaming path as the answer grows.
+
+Compares the incremental counter used by ChatGPT.send_message_stream with
+re-counting the prompt and the whole answer on every delta (the old behaviour).
+The incremental column should stay flat while the re-count column grows.
+
+Usage (from the repo root, with config/config.yml and config/config.env in place):
+    python benchmarks/bench_stream_token_counting.py
+"""
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+import openai_utils  # noqa: E402
+
+
+DELTA = "lorem ipsum "  # roughly one streamed delta
+N_CHUNKS = 4000
+WINDOW = 500
+
+
+def recount_tokens(messages, answer, encoding):
+    """The old per-delta count: the whole prompt and the whole answer, every time"""
+    n_input_tokens = openai_utils.TOKENS_PER_REPLY + sum(
+        openai_utils.TOKENS_PER_MESSAGE + openai_utils._count_content_tokens(message["content"], encoding)
+        for message in messages
+    )
+    n_output_tokens = 1 + len(encoding.encode(answer))
+    return n_input_tokens, n_output_tokens
+
+
+def main():
+    chatgpt = openai_utils.ChatGPT(model="gpt-4o-mini")
+    message = "Tell me a very long story"
+    messages = chatgpt._generate_prompt_messages(message, [], "assistant")
+
+    encoding = openai_utils.get_encoding(chatgpt.model)
+    _, n_input_tokens = chatgpt._fit_dialog_messages(message, [], "assistant")  # as send_message_stream does
+    token_counter = openai_utils._StreamTokenCounter(encoding, n_input_tokens)
+    answer = ""
+
+    incremental_time, recount_time = 0.0, 0.0
+    print(f"{'chunks':>8} {'answer chars':>13} {'incremental, us/chunk':>22} {'re-count, us/chunk':>19}")
+    for i in range(1, N_CHUNKS + 1):
+        start_time = time.perf_counter()
+        token_counter.add(DELTA)
+        token_counter.text
+        incremental_time += time.perf_counter() - start_time
+
+        start_time = time.perf_counter()
+        answer += DELTA
+        recount_tokens(messages, answer, encoding)
+        recount_time += time.perf_counter() - start_time
+
+        if i % WINDOW == 0:
+            print(f"{i:>8} {len(answer):>13} {incremental_time / WINDOW * 1e6:>22.1f} {recount_time / WINDOW * 1e6:>19.1f}")
+            incremental_time, recount_time = 0.0, 0.0
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,393 @@
+"""End-to-end load test of run_bot() against local stand-ins for Telegram and OpenAI.
+
+Starts a fake Telegram Bot API (getUpdates, sendMessage, editMessageText,
+getFile, file downloads, ...) and a fake OpenAI-compatible API (streamed chat
+completions at a configurable token rate, transcriptions, images) in this
+process, then runs bot/bot.py as a subprocess pointed at them through a
+temporary config dir (BOT_CONFIG_DIR) with the in-memory Mongo stand-in
+(or a real one with --mongodb-backend motor).
+
+N simulated users go through text, photo, voice and /retry flows in a loop.
+Each user sends the next message only after the previous answer is complete.
+The report shows updates/sec, time to first edit (p50/p95/p99) and the peak
+RSS of the bot process.
+
+Usage (from the repo root, needs `pip install -r benchmarks/requirements.txt`):
+    python benchmarks/load_test.py --users 50 --messages-per-user 8
+"""
+import argparse
+import asyncio
+import base64
+import io
+import itertools
+import json
+import os
+import shutil
+import signal
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import yaml
+from aiohttp import web
+from PIL import Image
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+BOT_TOKEN = "123456:load-test"
+BOT_USER = {"id": 123456, "is_bot": True, "first_name": "Load Test Bot", "username": "load_test_bot"}
+
+ANSWER_END = "EOT"  # last token of every fake answer: an edit containing it completes a flow
+FLOWS = ["text", "photo", "voice", "retry"]
+PHOTO_SIZES = [(90, 68), (320, 240), (800, 600), (1280, 960), (2560, 1920)]  # what Telegram sends for a 2560x1920 photo
+
+
+def percentile(values, q):
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))]
+
+
+def get_peak_rss_mb(pid):
+    """Peak resident set size of a process (Linux only)"""
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return float("nan")
+
+
+class Flow:
+    def __init__(self, kind):
+        self.kind = kind
+        self.start_time = time.perf_counter()
+        self.first_edit_time = None
+        self.done = asyncio.Event()
+        self.rejected = False
+
+
+class FakeTelegram:
+    """Just enough of the Bot API for the bot's handlers, with per-chat flow tracking"""
+
+    def __init__(self):
+        self._updates = []
+        self._has_updates = asyncio.Event()
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1)
+        self._flows = {}  # chat_id -> Flow in progress
+        self.polling_started = asyncio.Event()
+
+        self._files = {"voice.oga": os.urandom(16 * 1024)}  # never decoded, the fake transcriber ignores it
+        self._photo_sizes = []
+        for width, height in PHOTO_SIZES:
+            buf = io.BytesIO()
+            Image.effect_noise((width, height), 32).convert("RGB").save(buf, format="JPEG")
+            file_id = f"photo_{width}x{height}.jpg"
+            self._files[file_id] = buf.getvalue()
+            self._photo_sizes.append({"file_id": file_id, "file_unique_id": file_id, "width": width, "height": height})
+
+    def get_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/bot{token}/{method}", self.handle_method)
+        app.router.add_get("/file/bot{token}/{path:.+}", self.handle_file)
+        return app
+
+    def send_update(self, chat_id, kind):
+        user = {"id": chat_id, "is_bot": False, "first_name": f"User {chat_id}", "username": f"user{chat_id}"}
+        message = {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+        }
+        if kind == "text":
+            message["text"] = "Tell me something interesting about load testing"
+        elif kind == "retry":
+            message["text"] = "/retry"
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len("/retry")}]
+        elif kind == "photo":
+            message["caption"] = "What is in this picture?"
+            message["photo"] = self._photo_sizes
+        elif kind == "voice":
+            message["voice"] = {"file_id": "voice.oga", "file_unique_id": "voice", "duration": 3, "mime_type": "audio/ogg"}
+
+        flow = self._flows[chat_id] = Flow(kind)
+        self._updates.append({"update_id": next(self._update_ids), "message": message})
+        self._has_updates.set()
+        return flow
+
+    def _on_bot_message(self, chat_id, text, is_edit):
+        flow = self._flows.get(chat_id)
+        if flow is None or flow.done.is_set():
+            return
+
+        if is_edit and flow.first_edit_time is None:
+            flow.first_edit_time = time.perf_counter()
+        if text.startswith("⏳"):  # previous answer was still being saved, the user will resend
+            flow.rejected = True
+            flow.done.set()
+        elif ANSWER_END in text:
+            flow.done.set()
+
+    def _message(self, chat_id, text, message_id=None):
+        return {
+            "message_id": message_id or next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": BOT_USER,
+            "text": text,
+        }
+
+    async def _get_updates(self, params):
+        self.polling_started.set()
+
+        offset = int(params.get("offset", 0) or 0)
+        self._updates = [u for u in self._updates if u["update_id"] >= offset]
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout", 0) or 0))
+            except asyncio.TimeoutError:
+                pass
+
+        updates = self._updates[:int(params.get("limit", 100) or 100)]
+        return updates
+
+    async def handle_method(self, request):
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            params = dict(await request.post()) if request.method == "POST" else dict(request.query)
+
+        if method == "getUpdates":
+            result = await self._get_updates(params)
+        elif method == "getMe":
+            result = BOT_USER
+        elif method in ("sendMessage", "editMessageText"):
+            chat_id, text = int(params["chat_id"]), params["text"]
+            self._on_bot_message(chat_id, text, is_edit=(method == "editMessageText"))
+            result = self._message(chat_id, text, int(params.get("message_id", 0)))
+        elif method == "getFile":
+            file_id = params["file_id"]
+            result = {
+                "file_id": file_id,
+                "file_unique_id": file_id,
+                "file_size": len(self._files[file_id]),
+                "file_path": file_id,
+            }
+        else:  # setMyCommands, sendChatAction, deleteWebhook, ...
+            result = True
+
+        return web.json_response({"ok": True, "result": result})
+
+    async def handle_file(self, request):
+        return web.Response(body=self._files[request.match_info["path"]])
+
+
+class FakeOpenAI:
+    """OpenAI-compatible chat completions, transcriptions and image generations"""
+
+    def __init__(self, first_token_latency, token_rate, n_answer_tokens):
+        self.first_token_latency = first_token_latency
+        self.token_rate = token_rate
+        self.n_answer_tokens = n_answer_tokens
+
+        buf = io.BytesIO()
+        Image.new("RGB", (64, 64), (200, 120, 80)).save(buf, format="PNG")
+        self._image_b64 = base64.b64encode(buf.getvalue()).decode()
+
+    def get_app(self):
+        app = web.Application(client_max_size=64 * 1024 ** 2)
+        app.router.add_post("/v1/chat/completions", self.handle_chat_completions)
+        app.router.add_post("/v1/audio/transcriptions", self.handle_transcriptions)
+        app.router.add_post("/v1/images/generations", self.handle_image_generations)
+        return app
+
+    def _get_answer_tokens(self):
+        return [f"word{i} " for i in range(self.n_answer_tokens - 1)] + [ANSWER_END]
+
+    async def handle_chat_completions(self, request):
+        params = await request.json()
+        tokens = self._get_answer_tokens()
+        usage = {"prompt_tokens": 100, "completion_tokens": len(tokens), "total_tokens": 100 + len(tokens)}
+        await asyncio.sleep(self.first_token_latency)
+
+        if not params.get("stream"):
+            await asyncio.sleep(len(tokens) / self.token_rate)
+            return web.json_response({
+                "id": "chatcmpl-load-test",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": params["model"],
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+                "usage": usage,
+            })
+
+        response = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await response.prepare(request)
+
+        def chunk(choices, usage=None):
+            data = {
+                "id": "chatcmpl-load-test",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": params["model"],
+                "choices": choices,
+                "usage": usage,
+            }
+            return f"data: {json.dumps(data)}\n\n".encode()
+
+        for token in tokens:
+            await response.write(chunk([{"index": 0, "delta": {"content": token}, "finish_reason": None}]))
+            await asyncio.sleep(1 / self.token_rate)
+        await response.write(chunk([], usage))
+        await response.write(b"data: [DONE]\n\n")
+        return response
+
+    async def handle_transcriptions(self, request):
+        await request.read()
+        await asyncio.sleep(self.first_token_latency)
+        return web.json_response({"text": "Tell me something interesting about voice messages"})
+
+    async def handle_image_generations(self, request):
+        params = await request.json()
+        await asyncio.sleep(self.first_token_latency)
+        return web.json_response({
+            "created": int(time.time()),
+            "data": [{"b64_json": self._image_b64} for _ in range(params.get("n", 1))],
+        })
+
+
+async def start_server(app):
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, "127.0.0.1", 0)
+    await site.start()
+    host, port = runner.addresses[0][:2]
+    return runner, f"http://{host}:{port}"
+
+
+def write_config(config_dir, telegram_url, openai_url, args):
+    for filename in ("models.yml", "chat_modes.yml"):
+        shutil.copy(ROOT_DIR / "config" / filename, config_dir / filename)
+
+    with open(ROOT_DIR / "config" / "config.example.yml") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update({
+        "telegram_token": BOT_TOKEN,
+        "telegram_api_base": f"{telegram_url}/bot",
+        "telegram_file_api_base": f"{telegram_url}/file/bot",
+        "openai_api_key": "load-test",
+        "openai_api_base": f"{openai_url}/v1",
+        "openrouter_api_key": "load-test",
+        "openrouter_api_base": f"{openai_url}/v1",
+        "mongodb_backend": args.mongodb_backend,
+        "user_lock_backend": args.user_lock_backend,
+        "stream_edit_interval_private_chat": args.edit_interval,
+        "metrics_port": None,
+    })
+    with open(config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+
+    with open(config_dir / "config.env", "w") as f:
+        f.write(f"MONGODB_PORT={os.environ.get('MONGODB_PORT', 27017)}\n")
+
+
+async def run_user(telegram, chat_id, args, flows_done):
+    # /retry needs a previous message, so every user starts with a text message
+    flow_kinds = itertools.islice(itertools.cycle(FLOWS), args.messages_per_user)
+    for kind in flow_kinds:
+        while True:
+            flow = telegram.send_update(chat_id, kind)
+            await asyncio.wait_for(flow.done.wait(), args.timeout)
+            if not flow.rejected:
+                break
+            flows_done["rejected"] += 1
+            await asyncio.sleep(0.05)
+
+        flows_done[kind].append(flow)
+        await asyncio.sleep(args.think_time)
+
+
+async def main(args):
+    telegram = FakeTelegram()
+    openai_api = FakeOpenAI(args.first_token_latency, args.token_rate, args.answer_tokens)
+    telegram_runner, telegram_url = await start_server(telegram.get_app())
+    openai_runner, openai_url = await start_server(openai_api.get_app())
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        config_dir = Path(tmp_dir)
+        write_config(config_dir, telegram_url, openai_url, args)
+
+        log_file = open(config_dir / "bot.log", "w")
+        bot_process = await asyncio.create_subprocess_exec(
+            sys.executable, str(ROOT_DIR / "bot" / "bot.py"),
+            cwd=ROOT_DIR,
+            env={**os.environ, "BOT_CONFIG_DIR": str(config_dir)},
+            stdout=log_file,
+            stderr=asyncio.subprocess.STDOUT,
+        )
+
+        try:
+            await asyncio.wait_for(telegram.polling_started.wait(), 60)
+
+            flows_done = {kind: [] for kind in FLOWS}
+            flows_done["rejected"] = 0
+            start_time = time.perf_counter()
+            await asyncio.gather(*[
+                run_user(telegram, 1000 + i, args, flows_done)
+                for i in range(args.users)
+            ])
+            elapsed = time.perf_counter() - start_time
+            peak_rss_mb = get_peak_rss_mb(bot_process.pid)
+        except Exception:
+            log_file.flush()
+            print((config_dir / "bot.log").read_text()[-5000:], file=sys.stderr)
+            raise
+        finally:
+            if bot_process.returncode is None:
+                bot_process.send_signal(signal.SIGINT)
+                await bot_process.wait()
+            log_file.close()
+
+    await telegram_runner.cleanup()
+    await openai_runner.cleanup()
+
+    flows = [flow for kind in FLOWS for flow in flows_done[kind]]
+    print(f"users: {args.users}, messages per user: {args.messages_per_user}, "
+          f"token rate: {args.token_rate}/s, first token latency: {args.first_token_latency}s")
+    print(f"updates/sec: {len(flows) / elapsed:.1f} ({len(flows)} answered in {elapsed:.1f}s, "
+          f"{flows_done['rejected']} resent after 'please wait')")
+    print(f"{'flow':>8} {'count':>6} {'first edit p50, ms':>19} {'p95, ms':>8} {'p99, ms':>8}")
+    for kind in FLOWS + ["all"]:
+        kind_flows = flows if kind == "all" else flows_done[kind]
+        first_edit_times = [
+            (flow.first_edit_time - flow.start_time) * 1000
+            for flow in kind_flows if flow.first_edit_time is not None
+        ]
+        print(f"{kind:>8} {len(kind_flows):>6} {percentile(first_edit_times, 50):>19.0f} "
+              f"{percentile(first_edit_times, 95):>8.0f} {percentile(first_edit_times, 99):>8.0f}")
+    print(f"peak RSS of the bot process: {peak_rss_mb:.0f} MB")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--messages-per-user", type=int, default=8)
+    parser.add_argument("--token-rate", type=float, default=50.0, help="streamed tokens per second")
+    parser.add_argument("--first-token-latency", type=float, default=0.5, help="seconds before the first token")
+    parser.add_argument("--answer-tokens", type=int, default=100)
+    parser.add_argument("--edit-interval", type=float, default=1.0, help="stream_edit_interval_private_chat of the bot")
+    parser.add_argument("--think-time", type=float, default=0.2, help="seconds a user waits between answers")
+    parser.add_argument("--timeout", type=float, default=120.0, help="max seconds for one answer")
+    parser.add_argument("--mongodb-backend", choices=["memory", "motor"], default="memory")
+    parser.add_argument("--user-lock-backend", choices=["local", "mongodb"], default="local")
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,83 @@
+"""Soak test of the per-user lock registry: memory must stay flat as new users keep coming.
+
+Runs N distinct simulated users through LocalUserLocks (the in-process
+backend used by bot.py), in concurrent waves with a few repeat messages per
+wave, and prints the number of live registry entries and the process RSS
+along the way. With --leaky the same traffic also goes into a plain dict of
+semaphores that is never evicted, like the old `user_semaphores` registry,
+for comparison.
+
+Usage (from the repo root):
+    python benchmarks/soak_user_locks.py [--users 1000000] [--concurrency 1000] [--leaky]
+"""
+import argparse
+import asyncio
+import gc
+import resource
+import sys
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "bot"))
+
+import locks  # noqa: E402
+
+
+N_REPORTS = 10
+
+
+def get_rss_mb():
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024  # peak, on systems without /proc
+
+
+async def handle_message(user_locks, user_id, leaky_semaphores):
+    if leaky_semaphores is not None and user_id not in leaky_semaphores:
+        leaky_semaphores[user_id] = asyncio.Semaphore(1)
+
+    if await user_locks.is_locked(user_id):
+        return
+
+    async with user_locks.lock(user_id):
+        user_locks.set_task(user_id, asyncio.current_task())
+        await asyncio.sleep(0)  # the answer
+
+
+async def main(args):
+    user_locks = locks.LocalUserLocks()
+    leaky_semaphores = {} if args.leaky else None
+
+    report_every = max(args.users // N_REPORTS, args.concurrency)
+    print(f"{'users':>10} {'live entries':>13} {'leaky entries':>14} {'RSS, MB':>9} {'users/s':>9}")
+
+    start_time = time.perf_counter()
+    for wave_start in range(0, args.users, args.concurrency):
+        user_ids = range(wave_start, min(wave_start + args.concurrency, args.users))
+        # every user of the wave sends two messages at once, plus a few users send a third
+        await asyncio.gather(*(
+            handle_message(user_locks, user_id, leaky_semaphores)
+            for user_id in [*user_ids, *user_ids, *user_ids[:10]]
+        ))
+
+        n_users = user_ids[-1] + 1
+        if n_users % report_every == 0 or n_users == args.users:
+            gc.collect()
+            n_leaky = len(leaky_semaphores) if leaky_semaphores is not None else "-"
+            print(f"{n_users:>10} {len(user_locks):>13} {n_leaky:>14} {get_rss_mb():>9.1f} "
+                  f"{n_users / (time.perf_counter() - start_time):>9.0f}")
+
+    assert len(user_locks) == 0, "idle users were not evicted"
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=1_000_000)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--leaky", action="store_true", help="also keep the old never-evicted registry, for comparison")
+    asyncio.run(main(parser.parse_args()))
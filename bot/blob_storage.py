@@ -0,0 +1,84 @@
+import asyncio
+import hashlib
+import io
+import os
+import tempfile
+from pathlib import Path
+
+import pymongo
+
+
+def get_blob_id(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+class GridFSBlobStore:
+    """Content-addressed blobs in a GridFS bucket (motor bucket or a threaded pymongo one)"""
+
+    def __init__(self, bucket, files_collection):
+        self._bucket = bucket
+        self._files_collection = files_collection
+
+    async def put(self, data: bytes) -> str:
+        blob_id = get_blob_id(data)
+        if await self._files_collection.find_one({"_id": blob_id}, {"_id": 1}) is None:
+            try:
+                await self._bucket.upload_from_stream_with_id(blob_id, blob_id, data)
+            except pymongo.errors.DuplicateKeyError:
+                pass  # the same content was stored concurrently
+
+        return blob_id
+
+    async def get(self, blob_id: str) -> bytes:
+        buf = io.BytesIO()
+        await self._bucket.download_to_stream(blob_id, buf)
+        return buf.getvalue()
+
+
+class LocalBlobStore:
+    """Content-addressed blobs as files under a local directory"""
+
+    def __init__(self, path):
+        self.path = Path(path)
+
+    def _get_blob_path(self, blob_id: str) -> Path:
+        return self.path / blob_id[:2] / blob_id
+
+    def _write(self, blob_id: str, data: bytes):
+        blob_path = self._get_blob_path(blob_id)
+        if blob_path.exists():
+            return
+
+        blob_path.parent.mkdir(parents=True, exist_ok=True)
+        # a temp file of its own per writer: concurrent puts of the same blob must not share one
+        tmp_file = tempfile.NamedTemporaryFile(dir=blob_path.parent, prefix=f"{blob_id}.", suffix=".tmp", delete=False)
+        try:
+            with tmp_file:
+                tmp_file.write(data)
+            os.replace(tmp_file.name, blob_path)  # atomic, so readers never see partial files
+        except BaseException:
+            os.unlink(tmp_file.name)
+            raise
+
+    async def put(self, data: bytes) -> str:
+        blob_id = get_blob_id(data)
+        await asyncio.to_thread(self._write, blob_id, data)
+        return blob_id
+
+    async def get(self, blob_id: str) -> bytes:
+        return await asyncio.to_thread(self._get_blob_path(blob_id).read_bytes)
+
+
+class MemoryBlobStore:
+    """In-process blob store for the memory database backend"""
+
+    def __init__(self):
+        self._blobs = {}
+
+    async def put(self, data: bytes) -> str:
+        blob_id = get_blob_id(data)
+        self._blobs[blob_id] = data
+        return blob_id
+
+    async def get(self, blob_id: str) -> bytes:
+        return self._blobs[blob_id]
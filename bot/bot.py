@@ -1,9 +1,11 @@
 import io
 import logging
+import functools
 import asyncio
 import traceback
 import html
 import json
+import time
 from datetime import datetime
 import openai
 
@@ -13,6 +15,7 @@ from telegram import (
     User,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    InputMediaPhoto,
     BotCommand
 )
 from telegram.ext import (
@@ -27,18 +30,43 @@ from telegram.ext import (
 )
 from telegram.constants import ParseMode, ChatAction
 
+import audio_utils
+import compaction
 import config
 import database
+import http_transport
+import image_utils
+import locks
+import metrics
 import openai_utils
-
-import base64
+import telegram_utils
 
 # setup
 db = database.Database()
 logger = logging.getLogger(__name__)
 
-user_semaphores = {}
-user_tasks = {}
+edit_scheduler = telegram_utils.EditScheduler(
+    private_chat_interval=config.stream_edit_interval_private_chat,
+    group_chat_interval=config.stream_edit_interval_group_chat,
+    min_chars=config.stream_edit_min_chars,
+    max_edits_per_second=config.max_edits_per_second,
+)
+
+if config.user_lock_backend == "mongodb":
+    user_locks = locks.MongoUserLocks(
+        db.user_lock_collection,
+        lease_ttl=config.user_lock_ttl,
+        heartbeat_interval=config.user_lock_heartbeat_interval,
+    )
+else:
+    user_locks = locks.LocalUserLocks()
+
+metrics.USER_LOCKS.set_function(lambda: len(user_locks))
+
+UPSTREAM_OVERLOADED_TEXT = "😮‍💨 Too many requests right now. Please try again in a minute"
+PROVIDER_UNAVAILABLE_TEXT = "🥲 The AI provider is having problems right now. Please try again in a minute"
+STREAM_INTERRUPTED_TEXT = "⚠️ The answer was interrupted because the AI provider stopped responding"
+MAX_MEDIA_GROUP_SIZE = 10  # Telegram's limit of photos per album
 
 HELP_MESSAGE = """Commands:
 ⚪ /retry – Regenerate last bot answer
@@ -65,33 +93,56 @@ For example: "{bot_username} write a poem about Telegram"
 """
 
 
+def get_queue_position_text(queue_position: int) -> str:
+    # shown with the chat mode's parse_mode, so no markup
+    return f"⏳ Lots of requests right now, you are #{queue_position} in the queue..."
+
+
+def get_final_answer_text(answer: str, status: str) -> str:
+    # the notice is only shown, the dialog keeps the partial answer the model wrote;
+    # shown with the chat mode's parse_mode, so no markup
+    if status != "interrupted":
+        return answer
+    return f"{answer[:4096 - len(STREAM_INTERRUPTED_TEXT) - 2]}\n\n{STREAM_INTERRUPTED_TEXT}"
+
+
 def split_text_into_chunks(text, chunk_size):
     for i in range(0, len(text), chunk_size):
         yield text[i:i + chunk_size]
 
 
+def with_user_context(handler):
+    """Loads the user once per update and flushes all attribute changes when the handler finishes"""
+    @functools.wraps(handler)
+    async def wrapper(update: Update, context: CallbackContext, *args, **kwargs):
+        if update.effective_user is None:
+            return await handler(update, context, *args, **kwargs)
+
+        async with db.user_context(update.effective_user.id):
+            return await handler(update, context, *args, **kwargs)
+
+    return wrapper
+
+
 async def register_user_if_not_exists(update: Update, context: CallbackContext, user: User):
-    if not db.check_if_user_exists(user.id):
-        db.add_new_user(
+    if not await db.check_if_user_exists(user.id):
+        await db.add_new_user(
             user.id,
             update.message.chat_id,
             username=user.username,
             first_name=user.first_name,
             last_name= user.last_name
         )
-        db.start_new_dialog(user.id)
+        await db.start_new_dialog(user.id)
 
-    if db.get_user_attribute(user.id, "current_dialog_id") is None:
-        db.start_new_dialog(user.id)
+    if await db.get_user_attribute(user.id, "current_dialog_id") is None:
+        await db.start_new_dialog(user.id)
 
-    if user.id not in user_semaphores:
-        user_semaphores[user.id] = asyncio.Semaphore(1)
-
-    if db.get_user_attribute(user.id, "current_model") is None:
-        db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
+    if await db.get_user_attribute(user.id, "current_model") is None:
+        await db.set_user_attribute(user.id, "current_model", config.models["available_text_models"][0])
 
     # back compatibility for n_used_tokens field
-    n_used_tokens = db.get_user_attribute(user.id, "n_used_tokens")
+    n_used_tokens = await db.get_user_attribute(user.id, "n_used_tokens")
     if isinstance(n_used_tokens, int) or isinstance(n_used_tokens, float):  # old format
         new_n_used_tokens = {
             "gpt-3.5-turbo": {
@@ -99,15 +150,11 @@ async def register_user_if_not_exists(update: Update, context: CallbackContext,
                 "n_output_tokens": n_used_tokens
             }
         }
-        db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
-
-    # voice message transcription
-    if db.get_user_attribute(user.id, "n_transcribed_seconds") is None:
-        db.set_user_attribute(user.id, "n_transcribed_seconds", 0.0)
+        await db.set_user_attribute(user.id, "n_used_tokens", new_n_used_tokens)
+        await db.flush_user_context(user.id)  # must land before any $inc on n_used_tokens.<model>
 
-    # image generation
-    if db.get_user_attribute(user.id, "n_generated_images") is None:
-        db.set_user_attribute(user.id, "n_generated_images", 0)
+    # missing n_transcribed_seconds / n_generated_images fields need no migration:
+    # $inc creates them and Database.get_user_usage defaults them to 0
 
 
 async def is_bot_mentioned(update: Update, context: CallbackContext):
@@ -129,12 +176,13 @@ async def is_bot_mentioned(update: Update, context: CallbackContext):
          return False
 
 
+@with_user_context
 async def start_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
 
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.start_new_dialog(user_id)
 
     reply_text = "Hi! I'm <b>ChatGPT</b> bot implemented with OpenAI API 🤖\n\n"
     reply_text += HELP_MESSAGE
@@ -143,17 +191,19 @@ async def start_handle(update: Update, context: CallbackContext):
     await show_chat_modes_handle(update, context)
 
 
+@with_user_context
 async def help_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
     await update.message.reply_text(HELP_MESSAGE, parse_mode=ParseMode.HTML)
 
 
+@with_user_context
 async def help_group_chat_handle(update: Update, context: CallbackContext):
      await register_user_if_not_exists(update, context, update.message.from_user)
      user_id = update.message.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
      text = HELP_GROUP_CHAT_MESSAGE.format(bot_username="@" + context.bot.username)
 
@@ -161,29 +211,36 @@ async def help_group_chat_handle(update: Update, context: CallbackContext):
      await update.message.reply_video(config.help_group_chat_video_path)
 
 
+@with_user_context
 async def retry_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
-    if len(dialog_messages) == 0:
+    last_dialog_message = await db.pop_dialog_message(user_id, dialog_id=None)  # last message is removed from the context
+    if last_dialog_message is None:
         await update.message.reply_text("No message to retry 🤷‍♂️")
         return
 
-    last_dialog_message = dialog_messages.pop()
-    db.set_dialog_messages(user_id, dialog_messages, dialog_id=None)  # last message was removed from the context
+    message, image = last_dialog_message["user"], None
+    if isinstance(message, list):  # vision message: retry its text and its image
+        image_ids = [part["image_id"] for part in message if part["type"] == "image" and "image_id" in part]
+        if image_ids:
+            image_data = await db.blob_store.get(image_ids[0])
+            current_model = await db.get_user_attribute(user_id, "current_model")
+            image = await asyncio.to_thread(image_utils.prepare_image, image_data, current_model)
+        message = "\n".join(part["text"] for part in message if part["type"] == "text")
 
-    await message_handle(update, context, message=last_dialog_message["user"], use_new_dialog_timeout=False)
+    await message_handle(update, context, message=message, image=image, use_new_dialog_timeout=False)
 
 async def _vision_message_handle_fn(
-    update: Update, context: CallbackContext, use_new_dialog_timeout: bool = True
+    update: Update, context: CallbackContext, message=None, image=None, use_new_dialog_timeout: bool = True
 ):
     logger.info('_vision_message_handle_fn')
     user_id = update.message.from_user.id
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
     if not config.models["info"][current_model].get("vision", False):
         await update.message.reply_text(
@@ -192,109 +249,95 @@ async def _vision_message_handle_fn(
         )
         return
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
     # new dialog timeout
     if use_new_dialog_timeout:
-        if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-            db.start_new_dialog(user_id)
+        if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and await db.get_dialog_n_messages(user_id) > 0:
+            await db.start_new_dialog(user_id)
             await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    buf = None
-    if update.message.effective_attachment:
-        photo = update.message.effective_attachment[-1]
+    if image is None and update.message.photo:
+        # the smallest size with the model's resolution, not always the largest one
+        photo = image_utils.choose_photo_size(update.message.photo, current_model)
         photo_file = await context.bot.get_file(photo.file_id)
+        image_data = await photo_file.download_as_bytearray()  # in memory, not on disk
 
-        # store file in memory, not on disk
-        buf = io.BytesIO()
-        await photo_file.download_to_memory(buf)
-        buf.name = "image.jpg"  # file extension is required
-        buf.seek(0)  # move cursor to the beginning of the buffer
+        image = await asyncio.to_thread(image_utils.prepare_image, bytes(image_data), current_model)
 
     # in case of CancelledError
-    n_input_tokens, n_output_tokens = 0, 0
+    n_input_tokens, n_output_tokens, n_cached_input_tokens = 0, 0, 0
 
     try:
         # send placeholder message to user
         placeholder_message = await update.message.reply_text("...")
-        message = update.message.caption or update.message.text or ''
+        message = message or update.message.caption or update.message.text or ''
 
         # send typing action
         await update.message.chat.send_action(action="typing")
 
-        dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+        dialog_summary, dialog_messages = await db.get_dialog_history(user_id, dialog_id=None)
         parse_mode = {"html": ParseMode.HTML, "markdown": ParseMode.MARKDOWN}[
             config.chat_modes[chat_mode]["parse_mode"]
         ]
 
-        chatgpt_instance = openai_utils.ChatGPT(model=current_model)
-        if config.enable_message_streaming:
-            gen = chatgpt_instance.send_vision_message_stream(
-                message,
-                dialog_messages=dialog_messages,
-                image_buffer=buf,
-                chat_mode=chat_mode,
-            )
-        else:
-            (
-                answer,
-                (n_input_tokens, n_output_tokens),
-                n_first_dialog_messages_removed,
-            ) = await chatgpt_instance.send_vision_message(
-                message,
-                dialog_messages=dialog_messages,
-                image_buffer=buf,
-                chat_mode=chat_mode,
-            )
-
-            async def fake_gen():
-                yield "finished", answer, (
-                    n_input_tokens,
-                    n_output_tokens,
-                ), n_first_dialog_messages_removed
-
-            gen = fake_gen()
-
-        prev_answer = ""
-        async for gen_item in gen:
-            (
-                status,
-                answer,
-                (n_input_tokens, n_output_tokens),
-                n_first_dialog_messages_removed,
-            ) = gen_item
+        chatgpt_instance = openai_utils.ChatGPT(model=current_model, blob_store=db.blob_store, user_id=user_id)
+        async with telegram_utils.StreamedMessageEditor(
+            edit_scheduler,
+            context.bot,
+            placeholder_message,
+            parse_mode=parse_mode,
+            is_group_chat=update.message.chat.type != "private",
+        ) as message_editor:
+            if config.enable_message_streaming:
+                gen = chatgpt_instance.send_vision_message_stream(
+                    message,
+                    dialog_messages=dialog_messages,
+                    image=image,
+                    chat_mode=chat_mode,
+                    on_queue_position=lambda position: message_editor.show_status(get_queue_position_text(position)),
+                    dialog_summary=dialog_summary,
+                )
+            else:
+                (
+                    answer,
+                    (n_input_tokens, n_output_tokens, n_cached_input_tokens),
+                    n_first_dialog_messages_removed,
+                ) = await chatgpt_instance.send_vision_message(
+                    message,
+                    dialog_messages=dialog_messages,
+                    image=image,
+                    chat_mode=chat_mode,
+                    on_queue_position=lambda position: message_editor.show_status(get_queue_position_text(position)),
+                    dialog_summary=dialog_summary,
+                )
 
-            answer = answer[:4096]  # telegram message limit
+                async def fake_gen():
+                    yield "finished", answer, (
+                        n_input_tokens,
+                        n_output_tokens,
+                        n_cached_input_tokens,
+                    ), n_first_dialog_messages_removed
 
-            # update only when 100 new symbols are ready
-            if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                continue
+                gen = fake_gen()
 
-            try:
-                await context.bot.edit_message_text(
+            async for gen_item in gen:
+                (
+                    status,
                     answer,
-                    chat_id=placeholder_message.chat_id,
-                    message_id=placeholder_message.message_id,
-                    parse_mode=parse_mode,
-                )
-            except telegram.error.BadRequest as e:
-                if str(e).startswith("Message is not modified"):
-                    continue
-                else:
-                    await context.bot.edit_message_text(
-                        answer,
-                        chat_id=placeholder_message.chat_id,
-                        message_id=placeholder_message.message_id,
-                    )
+                    (n_input_tokens, n_output_tokens, n_cached_input_tokens),
+                    n_first_dialog_messages_removed,
+                ) = gen_item
 
-            await asyncio.sleep(0.01)  # wait a bit to avoid flooding
+                answer = answer[:4096]  # telegram message limit
+                message_editor.update(answer)
 
-            prev_answer = answer
+            await message_editor.finish(get_final_answer_text(answer, status))
 
         # update user data
-        if buf is not None:
-            base_image = base64.b64encode(buf.getvalue()).decode("utf-8")
+        if image is not None:
+            image_id = await db.blob_store.put(image.data)
             new_dialog_message = {"user": [
                         {
                             "type": "text",
@@ -302,26 +345,43 @@ async def _vision_message_handle_fn(
                         },
                         {
                             "type": "image",
-                            "image": base_image,
+                            "image_id": image_id,
+                            "width": image.width,
+                            "height": image.height,
+                            "detail": image.detail,
                         }
                     ]
                 , "bot": answer, "date": datetime.now()}
         else:
             new_dialog_message = {"user": [{"type": "text", "text": message}], "bot": answer, "date": datetime.now()}
+        new_dialog_message["n_tokens"] = openai_utils.count_dialog_message_tokens(new_dialog_message, current_model)
         
-        db.set_dialog_messages(
+        await db.append_dialog_message(
             user_id,
-            db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
+            new_dialog_message,
+            n_used_tokens=n_input_tokens + n_output_tokens,
             dialog_id=None
         )
+        compaction.schedule_compaction(
+            db, user_id, await db.get_user_attribute(user_id, "current_dialog_id"),
+            dialog_messages + [new_dialog_message], current_model
+        )
 
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, n_cached_input_tokens)
 
     except asyncio.CancelledError:
         # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-        db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+        await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, n_cached_input_tokens)
         raise
 
+    except openai_utils.UpstreamOverloadedError:
+        await update.message.reply_text(UPSTREAM_OVERLOADED_TEXT, parse_mode=ParseMode.HTML)
+        return
+
+    except openai_utils.ProviderUnavailableError:
+        await update.message.reply_text(PROVIDER_UNAVAILABLE_TEXT, parse_mode=ParseMode.HTML)
+        return
+
     except Exception as e:
         error_text = f"Something went wrong during completion. Reason: {e}"
         logger.error(error_text)
@@ -338,7 +398,8 @@ async def unsupport_message_handle(update: Update, context: CallbackContext, mes
     await update.message.reply_text(error_text)
     return
 
-async def message_handle(update: Update, context: CallbackContext, message=None, use_new_dialog_timeout=True):
+@with_user_context
+async def message_handle(update: Update, context: CallbackContext, message=None, image=None, use_new_dialog_timeout=True):
     # check if bot was mentioned (for group chats)
     if not await is_bot_mentioned(update, context):
         return
@@ -358,24 +419,24 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
 
     if chat_mode == "artist":
         await generate_image_handle(update, context, message=message)
         return
 
-    current_model = db.get_user_attribute(user_id, "current_model")
+    current_model = await db.get_user_attribute(user_id, "current_model")
 
     async def message_handle_fn():
         # new dialog timeout
         if use_new_dialog_timeout:
-            if (datetime.now() - db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and len(db.get_dialog_messages(user_id)) > 0:
-                db.start_new_dialog(user_id)
+            if (datetime.now() - await db.get_user_attribute(user_id, "last_interaction")).seconds > config.new_dialog_timeout and await db.get_dialog_n_messages(user_id) > 0:
+                await db.start_new_dialog(user_id)
                 await update.message.reply_text(f"Starting new dialog due to timeout (<b>{config.chat_modes[chat_mode]['name']}</b> mode) ✅", parse_mode=ParseMode.HTML)
-        db.set_user_attribute(user_id, "last_interaction", datetime.now())
+        await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
         # in case of CancelledError
-        n_input_tokens, n_output_tokens = 0, 0
+        n_input_tokens, n_output_tokens, n_cached_input_tokens = 0, 0, 0
 
         try:
             # send placeholder message to user
@@ -388,66 +449,80 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                  await update.message.reply_text("🥲 You sent <b>empty message</b>. Please, try again!", parse_mode=ParseMode.HTML)
                  return
 
-            dialog_messages = db.get_dialog_messages(user_id, dialog_id=None)
+            dialog_summary, dialog_messages = await db.get_dialog_history(user_id, dialog_id=None)
             parse_mode = {
                 "html": ParseMode.HTML,
                 "markdown": ParseMode.MARKDOWN
             }[config.chat_modes[chat_mode]["parse_mode"]]
 
-            chatgpt_instance = openai_utils.ChatGPT(model=current_model)
-            if config.enable_message_streaming:
-                gen = chatgpt_instance.send_message_stream(_message, dialog_messages=dialog_messages, chat_mode=chat_mode)
-            else:
-                answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
-                    _message,
-                    dialog_messages=dialog_messages,
-                    chat_mode=chat_mode
-                )
+            chatgpt_instance = openai_utils.ChatGPT(model=current_model, blob_store=db.blob_store, user_id=user_id)
+            async with telegram_utils.StreamedMessageEditor(
+                edit_scheduler,
+                context.bot,
+                placeholder_message,
+                parse_mode=parse_mode,
+                is_group_chat=update.message.chat.type != "private",
+            ) as message_editor:
+                if config.enable_message_streaming:
+                    gen = chatgpt_instance.send_message_stream(
+                        _message,
+                        dialog_messages=dialog_messages,
+                        chat_mode=chat_mode,
+                        on_queue_position=lambda position: message_editor.show_status(get_queue_position_text(position)),
+                        dialog_summary=dialog_summary,
+                    )
+                else:
+                    answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed = await chatgpt_instance.send_message(
+                        _message,
+                        dialog_messages=dialog_messages,
+                        chat_mode=chat_mode,
+                        on_queue_position=lambda position: message_editor.show_status(get_queue_position_text(position)),
+                        dialog_summary=dialog_summary,
+                    )
 
-                async def fake_gen():
-                    yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                    async def fake_gen():
+                        yield "finished", answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed
 
-                gen = fake_gen()
+                    gen = fake_gen()
 
-            prev_answer = ""
-            
-            async for gen_item in gen:
-                status, answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed = gen_item
+                async for gen_item in gen:
+                    status, answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed = gen_item
 
-                answer = answer[:4096]  # telegram message limit
-                    
-                # update only when 100 new symbols are ready
-                if abs(len(answer) - len(prev_answer)) < 100 and status != "finished":
-                    continue
-
-                try:
-                    await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id, parse_mode=parse_mode)
-                except telegram.error.BadRequest as e:
-                    if str(e).startswith("Message is not modified"):
-                        continue
-                    else:
-                        await context.bot.edit_message_text(answer, chat_id=placeholder_message.chat_id, message_id=placeholder_message.message_id)
-
-                await asyncio.sleep(0.01)  # wait a bit to avoid flooding
-                
-                prev_answer = answer
+                    answer = answer[:4096]  # telegram message limit
+                    message_editor.update(answer)
+
+                await message_editor.finish(get_final_answer_text(answer, status))
             
             # update user data
             new_dialog_message = {"user": [{"type": "text", "text": _message}], "bot": answer, "date": datetime.now()}
+            new_dialog_message["n_tokens"] = openai_utils.count_dialog_message_tokens(new_dialog_message, current_model)
 
-            db.set_dialog_messages(
+            await db.append_dialog_message(
                 user_id,
-                db.get_dialog_messages(user_id, dialog_id=None) + [new_dialog_message],
+                new_dialog_message,
+                n_used_tokens=n_input_tokens + n_output_tokens,
                 dialog_id=None
             )
+            compaction.schedule_compaction(
+                db, user_id, await db.get_user_attribute(user_id, "current_dialog_id"),
+                dialog_messages + [new_dialog_message], current_model
+            )
 
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, n_cached_input_tokens)
 
         except asyncio.CancelledError:
             # note: intermediate token updates only work when enable_message_streaming=True (config.yml)
-            db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens)
+            await db.update_n_used_tokens(user_id, current_model, n_input_tokens, n_output_tokens, n_cached_input_tokens)
             raise
 
+        except openai_utils.UpstreamOverloadedError:
+            await update.message.reply_text(UPSTREAM_OVERLOADED_TEXT, parse_mode=ParseMode.HTML)
+            return
+
+        except openai_utils.ProviderUnavailableError:
+            await update.message.reply_text(PROVIDER_UNAVAILABLE_TEXT, parse_mode=ParseMode.HTML)
+            return
+
         except Exception as e:
             error_text = f"Something went wrong during completion. Reason: {e}"
             logger.error(error_text)
@@ -462,41 +537,45 @@ async def message_handle(update: Update, context: CallbackContext, message=None,
                 text = f"✍️ <i>Note:</i> Your current dialog is too long, so <b>{n_first_dialog_messages_removed} first messages</b> were removed from the context.\n Send /new command to start new dialog"
             await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    async with user_semaphores[user_id]:
-        model_supports_vision = config.models["info"][current_model].get("vision", False)
-        photo_sent = update.message.photo is not None and len(update.message.photo) > 0
-        if model_supports_vision or photo_sent:
-            if not model_supports_vision:
-                # a photo was sent but the selected model can't read images:
-                # fall back to a vision-capable default
-                current_model = "gpt-4o"
-                db.set_user_attribute(user_id, "current_model", "gpt-4o")
-            task = asyncio.create_task(
-                _vision_message_handle_fn(update, context, use_new_dialog_timeout=use_new_dialog_timeout)
-            )
-        else:
-            task = asyncio.create_task(
-                message_handle_fn()
-            )
-
-        user_tasks[user_id] = task
+    queued_time = time.perf_counter()
+    async with user_locks.lock(user_id):
+        metrics.QUEUE_WAIT_DURATION.labels(queue="user").observe(time.perf_counter() - queued_time)
+        # an update that waited for the lock must see what the previous one wrote
+        await db.reload_user_context(user_id)
 
         try:
-            await task
-        except asyncio.CancelledError:
-            await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
-        else:
-            pass
+            model_supports_vision = config.models["info"][current_model].get("vision", False)
+            photo_sent = image is not None or (update.message.photo is not None and len(update.message.photo) > 0)
+            if model_supports_vision or photo_sent:
+                if not model_supports_vision:
+                    # a photo was sent but the selected model can't read images:
+                    # fall back to a vision-capable default
+                    current_model = "gpt-4o"
+                    await db.set_user_attribute(user_id, "current_model", "gpt-4o")
+                task = asyncio.create_task(
+                    _vision_message_handle_fn(update, context, message=_message, image=image, use_new_dialog_timeout=use_new_dialog_timeout)
+                )
+            else:
+                task = asyncio.create_task(
+                    message_handle_fn()
+                )
+
+            user_locks.set_task(user_id, task)
+
+            try:
+                await task
+            except asyncio.CancelledError:
+                await update.message.reply_text("✅ Canceled", parse_mode=ParseMode.HTML)
         finally:
-            if user_id in user_tasks:
-                del user_tasks[user_id]
+            # while the lock is held, so the user's next update reads it
+            await db.flush_user_context(user_id)
 
 
 async def is_previous_message_not_answered_yet(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    if user_semaphores[user_id].locked():
+    if await user_locks.is_locked(user_id):
         text = "⏳ Please <b>wait</b> for a reply to the previous message\n"
         text += "Or you can /cancel it"
         await update.message.reply_text(text, reply_to_message_id=update.message.id, parse_mode=ParseMode.HTML)
@@ -505,6 +584,7 @@ async def is_previous_message_not_answered_yet(update: Update, context: Callback
         return False
 
 
+@with_user_context
 async def voice_message_handle(update: Update, context: CallbackContext):
     # check if bot was mentioned (for group chats)
     if not await is_bot_mentioned(update, context):
@@ -514,33 +594,53 @@ async def voice_message_handle(update: Update, context: CallbackContext):
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     voice = update.message.voice
-    voice_file = await context.bot.get_file(voice.file_id)
-    
-    # store file in memory, not on disk
-    buf = io.BytesIO()
-    await voice_file.download_to_memory(buf)
-    buf.name = "voice.oga"  # file extension is required
-    buf.seek(0)  # move cursor to the beginning of the buffer
-
-    transcribed_text = await openai_utils.transcribe_audio(buf)
-    text = f"🎤: <i>{transcribed_text}</i>"
-    await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
-    # update n_transcribed_seconds
-    db.set_user_attribute(user_id, "n_transcribed_seconds", voice.duration + db.get_user_attribute(user_id, "n_transcribed_seconds"))
+    # forwarded voice messages keep their file_unique_id, so they are transcribed once
+    transcribed_text = None
+    if config.voice_transcript_cache_ttl > 0:
+        transcribed_text = await db.get_transcript(voice.file_unique_id)
+
+    if transcribed_text is not None:
+        await update.message.reply_text(f"🎤: <i>{html.escape(transcribed_text)}</i>", parse_mode=ParseMode.HTML)
+    else:
+        voice_file = await context.bot.get_file(voice.file_id)
+        voice_data = bytes(await voice_file.download_as_bytearray())  # in memory, not on disk
+
+        # long voice messages are transcribed in chunks, each shown as soon as it is ready
+        transcript_message = await update.message.reply_text("🎤: ...")
+        async with telegram_utils.StreamedMessageEditor(
+            edit_scheduler,
+            context.bot,
+            transcript_message,
+            parse_mode=ParseMode.HTML,
+            is_group_chat=update.message.chat.type != "private",
+        ) as message_editor:
+            transcribed_chunks = []
+            async for transcribed_chunk in audio_utils.transcribe_voice(voice_data, voice.duration, voice.mime_type or "audio/ogg"):
+                transcribed_chunks.append(transcribed_chunk.strip())
+                transcribed_text = " ".join(chunk for chunk in transcribed_chunks if chunk)
+                message_editor.update(f"🎤: <i>{html.escape(transcribed_text)}...</i>")
+            await message_editor.finish(f"🎤: <i>{html.escape(transcribed_text)}</i>")
+
+        # update n_transcribed_seconds
+        await db.inc_user_attributes(user_id, {"n_transcribed_seconds": voice.duration})
+
+        if config.voice_transcript_cache_ttl > 0:
+            await db.set_transcript(voice.file_unique_id, transcribed_text)
 
     await message_handle(update, context, message=transcribed_text)
 
 
+@with_user_context
 async def generate_image_handle(update: Update, context: CallbackContext, message=None):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     await update.message.chat.send_action(action="upload_photo")
 
@@ -557,38 +657,49 @@ async def generate_image_handle(update: Update, context: CallbackContext, messag
             raise
 
     # usage accounting
-    db.set_user_attribute(user_id, "n_generated_images", len(images) + db.get_user_attribute(user_id, "n_generated_images"))
+    await db.inc_user_attributes(user_id, {"n_generated_images": len(images)})
 
-    for image in images:
-        await update.message.chat.send_action(action="upload_photo")
-        await update.message.reply_photo(io.BytesIO(image))
+    await update.message.chat.send_action(action="upload_photo")
+    images = await asyncio.gather(*(
+        asyncio.to_thread(
+            image_utils.encode_generated_image, image, config.generated_image_format, config.generated_image_quality
+        )
+        for image in images
+    ))
+
+    # albums hold 2-10 photos, a single one goes as a plain photo
+    for i in range(0, len(images), MAX_MEDIA_GROUP_SIZE):
+        album = images[i:i + MAX_MEDIA_GROUP_SIZE]
+        if len(album) == 1:
+            await update.message.reply_photo(io.BytesIO(album[0]))
+        else:
+            await update.message.reply_media_group([InputMediaPhoto(io.BytesIO(image)) for image in album])
 
 
+@with_user_context
 async def new_dialog_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-    db.set_user_attribute(user_id, "current_model", "gpt-4o-mini")
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "current_model", "gpt-4o-mini")
 
-    db.start_new_dialog(user_id)
+    await db.start_new_dialog(user_id)
     await update.message.reply_text("Starting new dialog ✅")
 
-    chat_mode = db.get_user_attribute(user_id, "current_chat_mode")
+    chat_mode = await db.get_user_attribute(user_id, "current_chat_mode")
     await update.message.reply_text(f"{config.chat_modes[chat_mode]['welcome_message']}", parse_mode=ParseMode.HTML)
 
 
+@with_user_context
 async def cancel_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    if user_id in user_tasks:
-        task = user_tasks[user_id]
-        task.cancel()
-    else:
+    if not await user_locks.cancel(user_id):
         await update.message.reply_text("<i>Nothing to cancel...</i>", parse_mode=ParseMode.HTML)
 
 
@@ -629,23 +740,25 @@ def get_chat_mode_menu(page_index: int):
     return text, reply_markup
 
 
+@with_user_context
 async def show_chat_modes_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
     text, reply_markup = get_chat_mode_menu(0)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@with_user_context
 async def show_chat_modes_callback_handle(update: Update, context: CallbackContext):
      await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
      if await is_previous_message_not_answered_yet(update.callback_query, context): return
 
      user_id = update.callback_query.from_user.id
-     db.set_user_attribute(user_id, "last_interaction", datetime.now())
+     await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
      query = update.callback_query
      await query.answer()
@@ -662,6 +775,7 @@ async def show_chat_modes_callback_handle(update: Update, context: CallbackConte
              pass
 
 
+@with_user_context
 async def set_chat_mode_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
@@ -671,8 +785,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
 
     chat_mode = query.data.split("|")[1]
 
-    db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_chat_mode", chat_mode)
+    await db.start_new_dialog(user_id)
 
     await context.bot.send_message(
         update.callback_query.message.chat.id,
@@ -681,8 +795,8 @@ async def set_chat_mode_handle(update: Update, context: CallbackContext):
     )
 
 
-def get_settings_menu(user_id: int):
-    current_model = db.get_user_attribute(user_id, "current_model")
+async def get_settings_menu(user_id: int):
+    current_model = await db.get_user_attribute(user_id, "current_model")
     text = config.models["info"][current_model]["description"]
 
     text += "\n\n"
@@ -710,17 +824,19 @@ def get_settings_menu(user_id: int):
     return text, reply_markup
 
 
+@with_user_context
 async def settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update, context, update.message.from_user)
     if await is_previous_message_not_answered_yet(update, context): return
 
     user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     await update.message.reply_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
 
 
+@with_user_context
 async def set_settings_handle(update: Update, context: CallbackContext):
     await register_user_if_not_exists(update.callback_query, context, update.callback_query.from_user)
     user_id = update.callback_query.from_user.id
@@ -729,10 +845,10 @@ async def set_settings_handle(update: Update, context: CallbackContext):
     await query.answer()
 
     _, model_key = query.data.split("|")
-    db.set_user_attribute(user_id, "current_model", model_key)
-    db.start_new_dialog(user_id)
+    await db.set_user_attribute(user_id, "current_model", model_key)
+    await db.start_new_dialog(user_id)
 
-    text, reply_markup = get_settings_menu(user_id)
+    text, reply_markup = await get_settings_menu(user_id)
     try:
         await query.edit_message_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
     except telegram.error.BadRequest as e:
@@ -740,19 +856,14 @@ async def set_settings_handle(update: Update, context: CallbackContext):
             pass
 
 
-async def show_balance_handle(update: Update, context: CallbackContext):
-    await register_user_if_not_exists(update, context, update.message.from_user)
-
-    user_id = update.message.from_user.id
-    db.set_user_attribute(user_id, "last_interaction", datetime.now())
-
+def get_balance_text(usage: dict) -> str:
     # count total usage statistics
     total_n_spent_dollars = 0
     total_n_used_tokens = 0
 
-    n_used_tokens_dict = db.get_user_attribute(user_id, "n_used_tokens")
-    n_generated_images = db.get_user_attribute(user_id, "n_generated_images")
-    n_transcribed_seconds = db.get_user_attribute(user_id, "n_transcribed_seconds")
+    n_used_tokens_dict = usage["n_used_tokens"]
+    n_generated_images = usage["n_generated_images"]
+    n_transcribed_seconds = usage["n_transcribed_seconds"]
 
     details_text = "🏷️ Details:\n"
     for model_key in sorted(n_used_tokens_dict.keys()):
@@ -762,13 +873,19 @@ async def show_balance_handle(update: Update, context: CallbackContext):
             continue
 
         n_input_tokens, n_output_tokens = n_used_tokens_dict[model_key]["n_input_tokens"], n_used_tokens_dict[model_key]["n_output_tokens"]
+        n_cached_input_tokens = n_used_tokens_dict[model_key].get("n_cached_input_tokens", 0)  # part of n_input_tokens
         total_n_used_tokens += n_input_tokens + n_output_tokens
 
-        n_input_spent_dollars = config.models["info"][model_key]["price_per_1000_input_tokens"] * (n_input_tokens / 1000)
-        n_output_spent_dollars = config.models["info"][model_key]["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
+        model_info = config.models["info"][model_key]
+        n_input_spent_dollars = model_info["price_per_1000_input_tokens"] * ((n_input_tokens - n_cached_input_tokens) / 1000)
+        n_input_spent_dollars += model_info.get("price_per_1000_cached_input_tokens", model_info["price_per_1000_input_tokens"]) * (n_cached_input_tokens / 1000)
+        n_output_spent_dollars = model_info["price_per_1000_output_tokens"] * (n_output_tokens / 1000)
         total_n_spent_dollars += n_input_spent_dollars + n_output_spent_dollars
 
-        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>\n"
+        details_text += f"- {model_key}: <b>{n_input_spent_dollars + n_output_spent_dollars:.03f}$</b> / <b>{n_input_tokens + n_output_tokens} tokens</b>"
+        if n_cached_input_tokens > 0:
+            details_text += f" ({n_cached_input_tokens} cached)"
+        details_text += "\n"
 
     # image generation
     image_generation_n_spent_dollars = config.models["info"]["gpt-image-1"]["price_per_1_image"] * n_generated_images
@@ -789,6 +906,19 @@ async def show_balance_handle(update: Update, context: CallbackContext):
     text += f"You used <b>{total_n_used_tokens}</b> tokens\n\n"
     text += details_text
 
+    return text
+
+
+@with_user_context
+async def show_balance_handle(update: Update, context: CallbackContext):
+    await register_user_if_not_exists(update, context, update.message.from_user)
+
+    user_id = update.message.from_user.id
+    await db.set_user_attribute(user_id, "last_interaction", datetime.now())
+
+    usage = await db.get_user_usage(user_id)
+    text = get_balance_text(usage)
+
     await update.message.reply_text(text, parse_mode=ParseMode.HTML)
 
 
@@ -833,15 +963,36 @@ async def post_init(application: Application):
         BotCommand("/help", "Show help message"),
     ])
 
+    if db.usage_ledger is not None:
+        application.bot_data["usage_ledger_task"] = asyncio.create_task(db.usage_ledger.run())
+
+    if config.metrics_port:
+        metrics.start_server(config.metrics_port, config.metrics_addr)
+
+
+async def post_shutdown(application: Application):
+    if db.usage_ledger is not None:
+        application.bot_data["usage_ledger_task"].cancel()
+        await db.usage_ledger.flush()
+
+
 def run_bot() -> None:
+    try:
+        openai_utils.prewarm_encodings()
+    except Exception:
+        logger.exception("Failed to load tiktoken encodings, token counting will retry on first use")
+
     application = (
         ApplicationBuilder()
         .token(config.telegram_token)
+        .base_url(config.telegram_api_base)
+        .base_file_url(config.telegram_file_api_base)
         .concurrent_updates(True)
         .rate_limiter(AIORateLimiter(max_retries=5))
-        .http_version("1.1")
-        .get_updates_http_version("1.1")
+        .request(http_transport.TelegramRequest())
+        .update_queue(asyncio.Queue(maxsize=config.update_queue_size))
         .post_init(post_init)
+        .post_shutdown(post_shutdown)
         .build()
     )
 
@@ -880,7 +1031,24 @@ def run_bot() -> None:
     application.add_error_handler(error_handle)
 
     # start the bot
-    application.run_polling()
+    if config.update_mode == "webhook":
+        if config.webhook_url is None:
+            raise ValueError("Set webhook_url in config/config.yml to use update_mode: webhook")
+        if config.webhook_secret_token is None:
+            logger.warning("webhook_secret_token is not set, anyone who knows the webhook URL can send updates")
+
+        application.run_webhook(
+            listen=config.webhook_listen,
+            port=config.webhook_port,
+            url_path=config.webhook_path,
+            webhook_url=config.webhook_url,
+            secret_token=config.webhook_secret_token,
+            max_connections=config.webhook_max_connections,
+        )
+    elif config.update_mode == "polling":
+        application.run_polling()
+    else:
+        raise ValueError(f"Unknown update_mode: {config.update_mode}")
 
 
 if __name__ == "__main__":
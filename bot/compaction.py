@@ -0,0 +1,88 @@
+import asyncio
+import contextvars
+import logging
+
+import config
+import metrics
+import openai_utils
+
+
+logger = logging.getLogger(__name__)
+
+# dialog_id -> its running compaction, at most one per dialog
+_tasks = {}
+
+
+def _count_tokens(dialog_messages, model):
+    return sum(
+        dialog_message.get("n_tokens") or openai_utils.count_dialog_message_tokens(dialog_message, model)
+        for dialog_message in dialog_messages
+    )
+
+
+def needs_compaction(dialog_messages, model) -> bool:
+    """Whether the messages not covered by the dialog's summary are over dialog_compaction_threshold tokens"""
+    if not config.dialog_compaction_threshold or len(dialog_messages) <= get_n_kept_messages():
+        return False
+    return _count_tokens(dialog_messages, model) > config.dialog_compaction_threshold
+
+
+def get_n_kept_messages():
+    # the newest turns are always sent verbatim, and /retry pops the last one
+    return max(1, config.dialog_compaction_keep_messages)
+
+
+async def compact_dialog(db, user_id: int, dialog_id: str, model: str):
+    """Summarizes all but the newest messages of a dialog into its stored summary.
+
+    The summary is written only if the dialog did not change under it (see
+    Database.set_dialog_summary), and its tokens are billed to the user
+    under dialog_compaction_model.
+    """
+    summary, dialog_messages = await db.get_dialog_history(user_id, dialog_id=dialog_id)
+    n_new_summarized_messages = len(dialog_messages) - get_n_kept_messages()
+    if n_new_summarized_messages <= 0:
+        return
+
+    # queued as one anonymous user: compactions together get one fair share of the upstream slots
+    chatgpt_instance = openai_utils.ChatGPT(model=config.dialog_compaction_model)
+    text, (n_input_tokens, n_output_tokens, n_cached_input_tokens) = await chatgpt_instance.summarize_dialog(
+        dialog_messages[:n_new_summarized_messages],
+        previous_summary=summary["text"] if summary is not None else None,
+    )
+    await db.update_n_used_tokens(
+        user_id, config.dialog_compaction_model, n_input_tokens, n_output_tokens, n_cached_input_tokens
+    )
+
+    n_summarized_messages_before = summary["n_messages"] if summary is not None else 0
+    new_summary = {
+        "text": text,
+        "n_messages": n_summarized_messages_before + n_new_summarized_messages,
+        # part of the system message; counted with the dialog's model, which reads it
+        "n_tokens": len(openai_utils.get_encoding(model).encode(openai_utils.get_dialog_summary_text(text))),
+    }
+    if await db.set_dialog_summary(user_id, dialog_id, new_summary, n_summarized_messages_before):
+        metrics.DIALOG_COMPACTIONS.labels(outcome="stored").inc()
+        logger.debug(f"Compacted {n_new_summarized_messages} messages of dialog {dialog_id} into {new_summary['n_tokens']} tokens")
+    else:
+        metrics.DIALOG_COMPACTIONS.labels(outcome="discarded").inc()
+
+
+async def _run(db, user_id, dialog_id, model):
+    try:
+        await compact_dialog(db, user_id, dialog_id, model)
+    except Exception:
+        metrics.DIALOG_COMPACTIONS.labels(outcome="failed").inc()
+        logger.exception(f"Failed to compact dialog {dialog_id}, sending it in full")
+    finally:
+        del _tasks[dialog_id]
+
+
+def schedule_compaction(db, user_id: int, dialog_id: str, dialog_messages, model: str):
+    """Starts compacting the dialog in the background if `dialog_messages` (the ones not
+    covered by its summary yet) need it and no compaction of it is running already"""
+    if dialog_id in _tasks or not needs_compaction(dialog_messages, model):
+        return
+
+    # a fresh context: the handler's user snapshot is flushed before the compaction ends
+    _tasks[dialog_id] = asyncio.create_task(_run(db, user_id, dialog_id, model), context=contextvars.Context())
@@ -1,8 +1,10 @@
+import os
 import yaml
 import dotenv
 from pathlib import Path
 
-config_dir = Path(__file__).parent.parent.resolve() / "config"
+# BOT_CONFIG_DIR lets a process run against another config (e.g. the load test in benchmarks/)
+config_dir = Path(os.environ.get("BOT_CONFIG_DIR", Path(__file__).parent.parent.resolve() / "config"))
 
 # load yaml config
 with open(config_dir / "config.yml", 'r') as f:
@@ -13,17 +15,63 @@ config_env = dotenv.dotenv_values(config_dir / "config.env")
 
 # config parameters
 telegram_token = config_yaml["telegram_token"]
+telegram_api_base = config_yaml.get("telegram_api_base", "https://api.telegram.org/bot")
+telegram_file_api_base = config_yaml.get("telegram_file_api_base", "https://api.telegram.org/file/bot")
+update_mode = config_yaml.get("update_mode", "polling")
+webhook_url = config_yaml.get("webhook_url", None)
+webhook_listen = config_yaml.get("webhook_listen", "0.0.0.0")
+webhook_port = config_yaml.get("webhook_port", 8443)
+webhook_path = config_yaml.get("webhook_path", "telegram")
+webhook_secret_token = config_yaml.get("webhook_secret_token", None)
+webhook_max_connections = config_yaml.get("webhook_max_connections", 40)
+update_queue_size = config_yaml.get("update_queue_size", 0)
+user_lock_backend = config_yaml.get("user_lock_backend", "local")
+user_lock_ttl = config_yaml.get("user_lock_ttl", 30)
+user_lock_heartbeat_interval = config_yaml.get("user_lock_heartbeat_interval", 1.0)
 openai_api_key = config_yaml["openai_api_key"]
 openai_api_base = config_yaml.get("openai_api_base", None)
 openrouter_api_key = config_yaml.get("openrouter_api_key", None)
 openrouter_api_base = config_yaml.get("openrouter_api_base", "https://openrouter.ai/api/v1")
+http_transport = config_yaml.get("http_transport", None) or {}
 allowed_telegram_usernames = config_yaml["allowed_telegram_usernames"]
 new_dialog_timeout = config_yaml["new_dialog_timeout"]
 enable_message_streaming = config_yaml.get("enable_message_streaming", True)
+stream_edit_interval_private_chat = config_yaml.get("stream_edit_interval_private_chat", 1.0)
+stream_edit_interval_group_chat = config_yaml.get("stream_edit_interval_group_chat", 3.0)
+stream_edit_min_chars = config_yaml.get("stream_edit_min_chars", 20)
+max_edits_per_second = config_yaml.get("max_edits_per_second", 25)
 return_n_generated_images = config_yaml.get("return_n_generated_images", 1)
 image_size = config_yaml.get("image_size", "1024x1024")
+generated_image_format = config_yaml.get("generated_image_format", "jpeg")
+generated_image_quality = config_yaml.get("generated_image_quality", 90)
+vision_image_token_budget = config_yaml.get("vision_image_token_budget", 1445)
+voice_chunk_duration = config_yaml.get("voice_chunk_duration", 60)
+voice_max_concurrent_chunks = config_yaml.get("voice_max_concurrent_chunks", 4)
+voice_transcript_cache_ttl = config_yaml.get("voice_transcript_cache_ttl", 7 * 24 * 3600)
+dialog_compaction_threshold = config_yaml.get("dialog_compaction_threshold", 0)
+dialog_compaction_model = config_yaml.get("dialog_compaction_model", "gpt-4o-mini")
+dialog_compaction_keep_messages = config_yaml.get("dialog_compaction_keep_messages", 4)
 n_chat_modes_per_page = config_yaml.get("n_chat_modes_per_page", 5)
 mongodb_uri = f"mongodb://mongo:{config_env['MONGODB_PORT']}"
+mongodb_backend = config_yaml.get("mongodb_backend", "motor")
+mongodb_max_pool_size = config_yaml.get("mongodb_max_pool_size", 100)
+mongodb_min_pool_size = config_yaml.get("mongodb_min_pool_size", 0)
+usage_ledger_flush_interval = config_yaml.get("usage_ledger_flush_interval", 0)
+tiktoken_cache_dir = config_yaml.get("tiktoken_cache_dir", None)
+completion_cache_size = config_yaml.get("completion_cache_size", 1000)
+completion_cache_ttl = config_yaml.get("completion_cache_ttl", 3600)
+upstream_max_concurrent_requests = config_yaml.get("upstream_max_concurrent_requests", {"openai": 50, "openrouter": 50})
+upstream_max_queue_size = config_yaml.get("upstream_max_queue_size", 200)
+upstream_hedge_delay = config_yaml.get("upstream_hedge_delay", 10.0)
+circuit_breaker_window = config_yaml.get("circuit_breaker_window", 60)
+circuit_breaker_error_rate = config_yaml.get("circuit_breaker_error_rate", 0.5)
+circuit_breaker_min_requests = config_yaml.get("circuit_breaker_min_requests", 10)
+circuit_breaker_cooldown = config_yaml.get("circuit_breaker_cooldown", 30)
+stream_stall_timeout = config_yaml.get("stream_stall_timeout", 30)
+blob_storage = config_yaml.get("blob_storage", "gridfs")
+blob_storage_path = config_yaml.get("blob_storage_path", "./blobs")
+metrics_port = config_yaml.get("metrics_port", None)
+metrics_addr = config_yaml.get("metrics_addr", "0.0.0.0")
 
 # chat_modes
 with open(config_dir / "chat_modes.yml", 'r') as f:
@@ -1,22 +1,389 @@
 from typing import Optional, Any
 
+import asyncio
+import contextlib
+import contextvars
+import copy
+import logging
+import time
+import gridfs
 import pymongo
+import motor.motor_asyncio
 import uuid
-from datetime import datetime
+from collections import defaultdict
+from datetime import datetime, timedelta
 
 import config
+import blob_storage
+import metrics
 
 
-class Database:
+logger = logging.getLogger(__name__)
+
+# snapshot of the user whose update is being handled in the current task (see Database.user_context)
+_current_user_snapshot = contextvars.ContextVar("current_user_snapshot", default=None)
+
+
+def _timed(method):
+    """Records the duration of a Database method"""
+    return metrics.timed(metrics.DATABASE_OPERATION_DURATION, method=method.__name__)(method)
+
+
+class _ThreadedCollection:
+    """Sync pymongo collection (or GridFS bucket) whose methods run in worker threads, so they can be awaited"""
+
+    def __init__(self, collection):
+        self._collection = collection
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+
+        return call
+
+
+class _CountingCollection:
+    """Counts every awaited collection call, i.e. every round trip to MongoDB"""
+
+    def __init__(self, collection, database: "Database"):
+        self._collection = collection
+        self._database = database
+
+    def __getattr__(self, name):
+        method = getattr(self._collection, name)
+
+        async def call(*args, **kwargs):
+            self._database.n_round_trips += 1
+            snapshot = _current_user_snapshot.get()
+            if snapshot is not None:
+                snapshot.n_round_trips += 1
+            return await method(*args, **kwargs)
+
+        return call
+
+
+class UserSnapshot:
+    """User document loaded at most once per update.
+
+    Attribute reads are answered from memory and attribute writes are collected
+    in `changes`, to be flushed with a single $set when the update is handled.
+    """
+
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self.document = None
+        self.loaded = False
+        self.changes = {}
+        self.n_round_trips = 0
+
+
+class _MemoryCollection:
+    """In-process stand-in for a MongoDB collection (tests and benchmarks only).
+
+    Supports just the subset of queries and update operators used by Database.
+    """
+
+    _MISSING = object()
+
     def __init__(self):
-        self.client = pymongo.MongoClient(config.mongodb_uri)
-        self.db = self.client["chatgpt_telegram_bot"]
+        self._documents = {}
+
+    @classmethod
+    def _get_path(cls, document: dict, path: str, default: Any = _MISSING):
+        value = document
+        for key in path.split("."):
+            if isinstance(value, dict) and key in value:
+                value = value[key]
+            elif isinstance(value, list) and key.isdigit() and int(key) < len(value):
+                value = value[int(key)]
+            else:
+                return default
+        return value
+
+    @staticmethod
+    def _set_path(document: dict, path: str, value: Any):
+        *parent_keys, last_key = path.split(".")
+        for key in parent_keys:
+            document = document.setdefault(key, {})
+        document[last_key] = value
+
+    @classmethod
+    def _matches(cls, document: dict, filter: dict) -> bool:
+        for path, condition in filter.items():
+            value = cls._get_path(document, path)
+            if isinstance(condition, dict) and "$exists" in condition:
+                if (value is not cls._MISSING) != condition["$exists"]:
+                    return False
+            elif isinstance(condition, dict) and "$lt" in condition:
+                if value is cls._MISSING or not value < condition["$lt"]:
+                    return False
+            elif isinstance(condition, dict) and "$gt" in condition:
+                if value is cls._MISSING or not value > condition["$gt"]:
+                    return False
+            elif value is cls._MISSING or value != condition:
+                return False
+        return True
+
+    def _find(self, filter: dict):
+        for document in self._documents.values():
+            if self._matches(document, filter):
+                return document
+        return None
+
+    async def count_documents(self, filter: dict) -> int:
+        return sum(self._matches(document, filter) for document in self._documents.values())
+
+    async def find_one(self, filter: dict, projection: Optional[dict] = None):
+        # projections are ignored: callers always get the full document
+        document = self._find(filter)
+        return copy.deepcopy(document)
+
+    async def find_one_and_update(self, filter: dict, update: dict, projection: Optional[dict] = None):
+        # returns the document as it was before the update (pymongo's default)
+        document = copy.deepcopy(self._find(filter))
+        await self.update_one(filter, update)
+        return document
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        # pymongo's UpdateOne has no public accessors for its filter and update
+        for request in requests:
+            await self.update_one(request._filter, request._doc)
+
+    async def delete_one(self, filter: dict):
+        document = self._find(filter)
+        if document is not None:
+            del self._documents[document["_id"]]
+
+    async def insert_one(self, document: dict):
+        if document["_id"] in self._documents:
+            raise pymongo.errors.DuplicateKeyError(f"Duplicate _id: {document['_id']}")
+        self._documents[document["_id"]] = copy.deepcopy(document)
+
+    async def update_one(self, filter: dict, update: dict, upsert: bool = False):
+        document = self._find(filter)
+        if document is None:
+            if not upsert:
+                return
+            # like MongoDB, the upserted document takes the equality conditions of the filter
+            document = {key: value for key, value in filter.items() if not isinstance(value, dict)}
+            if document["_id"] in self._documents:
+                raise pymongo.errors.DuplicateKeyError(f"Duplicate _id: {document['_id']}")
+            self._documents[document["_id"]] = document
+
+        for operator, fields in update.items():
+            for key, value in fields.items():
+                if operator == "$set":
+                    self._set_path(document, key, copy.deepcopy(value))
+                elif operator == "$inc":
+                    self._set_path(document, key, self._get_path(document, key, default=0) + value)
+                elif operator == "$push":
+                    document.setdefault(key, []).append(copy.deepcopy(value))
+                elif operator == "$pop":
+                    if document.get(key):
+                        document[key].pop(-1 if value == 1 else 0)
+                else:
+                    raise NotImplementedError(f"Update operator {operator} is not supported")
+
+
+def _escape_key(key: str) -> str:
+    # model names like "openai/gpt-5.5" can't be used as-is in dotted update paths
+    return key.replace(".", "\uff0e")
+
+
+def _unescape_key(key: str) -> str:
+    return key.replace("\uff0e", ".")
+
+
+class UsageLedger:
+    """Buffers usage counter increments in process and writes them with one bulk_write per flush"""
+
+    def __init__(self, collection, flush_interval: float):
+        self._collection = collection
+        self.flush_interval = flush_interval
+
+        self._increments = defaultdict(lambda: defaultdict(int))  # user_id -> {field path: increment}
+
+    def add(self, user_id: int, increments: dict):
+        for path, value in increments.items():
+            self._increments[user_id][path] += value
+
+    def get_pending(self, user_id: int) -> dict:
+        return dict(self._increments.get(user_id, {}))
+
+    async def flush(self):
+        if len(self._increments) == 0:
+            return
+
+        increments, self._increments = self._increments, defaultdict(lambda: defaultdict(int))
+        increments = list(increments.items())
+        requests = [
+            pymongo.UpdateOne({"_id": user_id}, {"$inc": dict(user_increments)})
+            for user_id, user_increments in increments
+        ]
+
+        try:
+            await self._collection.bulk_write(requests, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            # an unordered bulk write applies every other op: keep just the failed ones for the next flush
+            for write_error in e.details["writeErrors"]:
+                self.add(*increments[write_error["index"]])
+            raise
+        except Exception:
+            # nothing is known to be written (e.g. the connection failed): keep all increments
+            for user_id, user_increments in increments:
+                self.add(user_id, user_increments)
+            raise
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+
+            start_time = time.monotonic()
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to flush usage ledger")
+            else:
+                logger.debug(f"Usage ledger flushed in {time.monotonic() - start_time:.3f}s")
+
+
+class Database:
+    def __init__(self, backend: Optional[str] = None):
+        backend = backend or config.mongodb_backend
+
+        if backend == "motor":
+            self.client = motor.motor_asyncio.AsyncIOMotorClient(
+                config.mongodb_uri,
+                maxPoolSize=config.mongodb_max_pool_size,
+                minPoolSize=config.mongodb_min_pool_size,
+            )
+            self.db = self.client["chatgpt_telegram_bot"]
+
+            self.user_collection = self.db["user"]
+            self.dialog_collection = self.db["dialog"]
+            self.user_lock_collection = self.db["user_lock"]
+            self.transcript_collection = self.db["transcript"]
+
+            self.blob_store = blob_storage.GridFSBlobStore(
+                motor.motor_asyncio.AsyncIOMotorGridFSBucket(self.db, bucket_name="blob"),
+                self.db["blob.files"]
+            )
+        elif backend == "pymongo":
+            self.client = pymongo.MongoClient(
+                config.mongodb_uri,
+                maxPoolSize=config.mongodb_max_pool_size,
+                minPoolSize=config.mongodb_min_pool_size,
+            )
+            self.db = self.client["chatgpt_telegram_bot"]
+
+            self.user_collection = _ThreadedCollection(self.db["user"])
+            self.dialog_collection = _ThreadedCollection(self.db["dialog"])
+            self.user_lock_collection = _ThreadedCollection(self.db["user_lock"])
+            self.transcript_collection = _ThreadedCollection(self.db["transcript"])
+
+            self.blob_store = blob_storage.GridFSBlobStore(
+                _ThreadedCollection(gridfs.GridFSBucket(self.db, bucket_name="blob")),
+                _ThreadedCollection(self.db["blob.files"])
+            )
+        elif backend == "memory":
+            self.client = None
+            self.db = None
+
+            self.user_collection = _MemoryCollection()
+            self.dialog_collection = _MemoryCollection()
+            self.user_lock_collection = _MemoryCollection()
+            self.transcript_collection = _MemoryCollection()
+
+            self.blob_store = blob_storage.MemoryBlobStore()
+        else:
+            raise ValueError(f"Unknown MongoDB backend: {backend}")
+
+        self.backend = backend
+
+        if config.blob_storage == "local":
+            self.blob_store = blob_storage.LocalBlobStore(config.blob_storage_path)
 
-        self.user_collection = self.db["user"]
-        self.dialog_collection = self.db["dialog"]
+        self.n_round_trips = 0
+        self.user_collection = _CountingCollection(self.user_collection, self)
+        self.dialog_collection = _CountingCollection(self.dialog_collection, self)
+        self.transcript_collection = _CountingCollection(self.transcript_collection, self)
 
-    def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
-        if self.user_collection.count_documents({"_id": user_id}) > 0:
+        self.usage_ledger = None
+        if config.usage_ledger_flush_interval > 0:
+            self.usage_ledger = UsageLedger(self.user_collection, config.usage_ledger_flush_interval)
+
+    @contextlib.asynccontextmanager
+    async def user_context(self, user_id: int):
+        """Serves user attribute reads and writes of one update from a single snapshot.
+
+        The user document is fetched lazily on first access and all attribute
+        changes are written back with one update_one when the context exits.
+        Nested contexts for the same user reuse the outer snapshot.
+        """
+        snapshot = _current_user_snapshot.get()
+        if snapshot is not None and snapshot.user_id == user_id:
+            yield snapshot
+            return
+
+        snapshot = UserSnapshot(user_id)
+        token = _current_user_snapshot.set(snapshot)
+        try:
+            yield snapshot
+        finally:
+            try:
+                await self._flush_user_snapshot(snapshot)
+            finally:
+                _current_user_snapshot.reset(token)
+                logger.debug(f"User {user_id}: {snapshot.n_round_trips} MongoDB round trips")
+
+    async def _get_user_snapshot(self, user_id: int) -> Optional[UserSnapshot]:
+        snapshot = _current_user_snapshot.get()
+        if snapshot is None or snapshot.user_id != user_id:
+            return None
+
+        if not snapshot.loaded:
+            snapshot.document = await self.user_collection.find_one({"_id": user_id})
+            snapshot.loaded = True
+
+        return snapshot
+
+    @_timed
+    async def flush_user_context(self, user_id: int):
+        """Writes pending attribute changes of the current snapshot right away"""
+        snapshot = await self._get_user_snapshot(user_id)
+        if snapshot is not None:
+            await self._flush_user_snapshot(snapshot)
+
+    @_timed
+    async def reload_user_context(self, user_id: int):
+        """Writes pending attribute changes of the current snapshot and makes the
+        next read fetch the user again, e.g. after waiting for the user's lock"""
+        snapshot = _current_user_snapshot.get()
+        if snapshot is None or snapshot.user_id != user_id:
+            return
+
+        await self._flush_user_snapshot(snapshot)
+        snapshot.document = None
+        snapshot.loaded = False
+
+    async def _flush_user_snapshot(self, snapshot: UserSnapshot):
+        if snapshot.document is None or len(snapshot.changes) == 0:
+            return
+
+        changes, snapshot.changes = snapshot.changes, {}
+        await self.user_collection.update_one({"_id": snapshot.user_id}, {"$set": changes})
+
+    @_timed
+    async def check_if_user_exists(self, user_id: int, raise_exception: bool = False):
+        snapshot = await self._get_user_snapshot(user_id)
+        if snapshot is not None:
+            user_exists = snapshot.document is not None
+        else:
+            user_exists = await self.user_collection.count_documents({"_id": user_id}) > 0
+
+        if user_exists:
             return True
         else:
             if raise_exception:
@@ -24,7 +391,8 @@ class Database:
             else:
                 return False
 
-    def add_new_user(
+    @_timed
+    async def add_new_user(
         self,
         user_id: int,
         chat_id: int,
@@ -53,76 +421,247 @@ class Database:
             "n_transcribed_seconds": 0.0  # voice message transcription
         }
 
-        if not self.check_if_user_exists(user_id):
-            self.user_collection.insert_one(user_dict)
+        if not await self.check_if_user_exists(user_id):
+            await self.user_collection.insert_one(user_dict)
 
-    def start_new_dialog(self, user_id: int):
-        self.check_if_user_exists(user_id, raise_exception=True)
+            snapshot = await self._get_user_snapshot(user_id)
+            if snapshot is not None:
+                snapshot.document = user_dict
+
+    @_timed
+    async def start_new_dialog(self, user_id: int):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         dialog_id = str(uuid.uuid4())
         dialog_dict = {
             "_id": dialog_id,
             "user_id": user_id,
-            "chat_mode": self.get_user_attribute(user_id, "current_chat_mode"),
+            "chat_mode": await self.get_user_attribute(user_id, "current_chat_mode"),
             "start_time": datetime.now(),
-            "model": self.get_user_attribute(user_id, "current_model"),
-            "messages": []
+            "model": await self.get_user_attribute(user_id, "current_model"),
+            "messages": [],
+            "n_messages": 0,
+            "n_used_tokens": 0
         }
 
         # add new dialog
-        self.dialog_collection.insert_one(dialog_dict)
+        await self.dialog_collection.insert_one(dialog_dict)
 
         # update user's current dialog
-        self.user_collection.update_one(
-            {"_id": user_id},
-            {"$set": {"current_dialog_id": dialog_id}}
-        )
+        await self.set_user_attribute(user_id, "current_dialog_id", dialog_id)
 
         return dialog_id
 
-    def get_user_attribute(self, user_id: int, key: str):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        user_dict = self.user_collection.find_one({"_id": user_id})
+    @_timed
+    async def get_user_attribute(self, user_id: int, key: str):
+        snapshot = await self._get_user_snapshot(user_id)
+        if snapshot is not None:
+            user_dict = snapshot.document
+        else:
+            user_dict = await self.user_collection.find_one({"_id": user_id})
+
+        if user_dict is None:
+            raise ValueError(f"User {user_id} does not exist")
 
         if key not in user_dict:
             return None
 
         return user_dict[key]
 
-    def set_user_attribute(self, user_id: int, key: str, value: Any):
-        self.check_if_user_exists(user_id, raise_exception=True)
-        self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
+    @_timed
+    async def set_user_attribute(self, user_id: int, key: str, value: Any):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
-    def update_n_used_tokens(self, user_id: int, model: str, n_input_tokens: int, n_output_tokens: int):
-        n_used_tokens_dict = self.get_user_attribute(user_id, "n_used_tokens")
+        snapshot = await self._get_user_snapshot(user_id)
+        if snapshot is not None:
+            snapshot.document[key] = value
+            snapshot.changes[key] = value
+        else:
+            await self.user_collection.update_one({"_id": user_id}, {"$set": {key: value}})
 
-        if model in n_used_tokens_dict:
-            n_used_tokens_dict[model]["n_input_tokens"] += n_input_tokens
-            n_used_tokens_dict[model]["n_output_tokens"] += n_output_tokens
+    @_timed
+    async def inc_user_attributes(self, user_id: int, increments: dict):
+        """Atomically increments numeric user fields (dotted paths allowed).
+
+        Goes through the usage ledger when it is enabled, so the write may be deferred
+        until its next flush.
+        """
+        if self.usage_ledger is not None:
+            self.usage_ledger.add(user_id, increments)
         else:
-            n_used_tokens_dict[model] = {
-                "n_input_tokens": n_input_tokens,
-                "n_output_tokens": n_output_tokens
-            }
+            await self.user_collection.update_one({"_id": user_id}, {"$inc": increments})
 
-        self.set_user_attribute(user_id, "n_used_tokens", n_used_tokens_dict)
+    @_timed
+    async def update_n_used_tokens(
+        self,
+        user_id: int,
+        model: str,
+        n_input_tokens: int,
+        n_output_tokens: int,
+        n_cached_input_tokens: int = 0  # included in n_input_tokens
+    ):
+        model_key = _escape_key(model)
+        await self.inc_user_attributes(user_id, {
+            f"n_used_tokens.{model_key}.n_input_tokens": n_input_tokens,
+            f"n_used_tokens.{model_key}.n_output_tokens": n_output_tokens,
+            f"n_used_tokens.{model_key}.n_cached_input_tokens": n_cached_input_tokens,
+        })
 
-    def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    @_timed
+    async def get_user_usage(self, user_id: int) -> dict:
+        """Returns n_used_tokens (per model), n_generated_images and n_transcribed_seconds,
+        including increments still buffered in the usage ledger"""
+        n_used_tokens = defaultdict(lambda: defaultdict(int))
+        for model_key, model_n_used_tokens in (await self.get_user_attribute(user_id, "n_used_tokens") or {}).items():
+            # older documents may hold the same model under its unescaped name
+            for key, value in model_n_used_tokens.items():
+                n_used_tokens[_unescape_key(model_key)][key] += value
+
+        usage = {
+            "n_generated_images": await self.get_user_attribute(user_id, "n_generated_images") or 0,
+            "n_transcribed_seconds": await self.get_user_attribute(user_id, "n_transcribed_seconds") or 0.0,
+        }
+
+        if self.usage_ledger is not None:
+            for path, value in self.usage_ledger.get_pending(user_id).items():
+                if path.startswith("n_used_tokens."):
+                    _, model_key, key = path.split(".")
+                    n_used_tokens[_unescape_key(model_key)][key] += value
+                else:
+                    usage[path] += value
+
+        usage["n_used_tokens"] = {model: dict(model_n_used_tokens) for model, model_n_used_tokens in n_used_tokens.items()}
+
+        return usage
+
+    @_timed
+    async def get_dialog_messages(self, user_id: int, dialog_id: Optional[str] = None):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        dialog_dict = self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
         return dialog_dict["messages"]
 
-    def set_dialog_messages(self, user_id: int, dialog_messages: list, dialog_id: Optional[str] = None):
-        self.check_if_user_exists(user_id, raise_exception=True)
+    @_timed
+    async def get_dialog_history(self, user_id: int, dialog_id: Optional[str] = None) -> tuple:
+        """The dialog's summary (None until it is compacted) and the messages it does not cover yet.
+
+        The summary is {text, n_messages, n_tokens}: it replaces the first
+        `n_messages` messages in prompts (see compaction.py).
+        """
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = await self.dialog_collection.find_one({"_id": dialog_id, "user_id": user_id})
+        summary = dialog_dict.get("summary")
+        n_summarized_messages = summary["n_messages"] if summary is not None else 0
+        return summary, dialog_dict["messages"][n_summarized_messages:]
+
+    @_timed
+    async def set_dialog_summary(
+        self,
+        user_id: int,
+        dialog_id: str,
+        summary: dict,
+        n_summarized_messages_before: int = 0
+    ) -> bool:
+        """Stores a new summary unless another one was stored since `n_summarized_messages_before`
+        was read, or /retry removed messages it covers. Returns whether it was stored."""
+        filter = {
+            "_id": dialog_id,
+            "user_id": user_id,
+            f"messages.{summary['n_messages'] - 1}": {"$exists": True},
+        }
+        if n_summarized_messages_before == 0:
+            filter["summary.n_messages"] = {"$exists": False}
+        else:
+            filter["summary.n_messages"] = n_summarized_messages_before
+
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            filter,
+            {"$set": {"summary": summary}},
+            projection={"_id": 1}
+        )
+        return dialog_dict is not None
+
+    @_timed
+    async def get_dialog_n_messages(self, user_id: int, dialog_id: Optional[str] = None) -> int:
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = await self.dialog_collection.find_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"n_messages": 1}
+        )
+        if "n_messages" in dialog_dict:
+            return dialog_dict["n_messages"]
+
+        # dialogs created before the counter existed: backfill it once
+        n_messages = len(await self.get_dialog_messages(user_id, dialog_id=dialog_id))
+        await self.dialog_collection.update_one(
+            {"_id": dialog_id, "user_id": user_id},
+            {"$set": {"n_messages": n_messages}}
+        )
+        return n_messages
+
+    @_timed
+    async def append_dialog_message(
+        self,
+        user_id: int,
+        dialog_message: dict,
+        n_used_tokens: int = 0,
+        dialog_id: Optional[str] = None
+    ):
+        await self.check_if_user_exists(user_id, raise_exception=True)
 
         if dialog_id is None:
-            dialog_id = self.get_user_attribute(user_id, "current_dialog_id")
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
 
-        self.dialog_collection.update_one(
+        await self.dialog_collection.update_one(
             {"_id": dialog_id, "user_id": user_id},
-            {"$set": {"messages": dialog_messages}}
+            {
+                "$push": {"messages": dialog_message},
+                "$inc": {"n_messages": 1, "n_used_tokens": n_used_tokens}
+            }
+        )
+
+    @_timed
+    async def pop_dialog_message(self, user_id: int, dialog_id: Optional[str] = None) -> Optional[dict]:
+        """Removes the last message of the dialog and returns it (None if the dialog is empty)"""
+        await self.check_if_user_exists(user_id, raise_exception=True)
+
+        if dialog_id is None:
+            dialog_id = await self.get_user_attribute(user_id, "current_dialog_id")
+
+        dialog_dict = await self.dialog_collection.find_one_and_update(
+            {"_id": dialog_id, "user_id": user_id, "messages.0": {"$exists": True}},
+            {"$pop": {"messages": 1}, "$inc": {"n_messages": -1}},
+            projection={"messages": {"$slice": -1}}
+        )
+        if dialog_dict is None:
+            return None
+
+        return dialog_dict["messages"][-1]
+
+    @_timed
+    async def get_transcript(self, file_unique_id: str) -> Optional[str]:
+        """Cached transcript of a voice message, the same for all its forwards"""
+        transcript_dict = await self.transcript_collection.find_one({
+            "_id": file_unique_id,
+            "created": {"$gt": datetime.now() - timedelta(seconds=config.voice_transcript_cache_ttl)},
+        })
+        return None if transcript_dict is None else transcript_dict["text"]
+
+    @_timed
+    async def set_transcript(self, file_unique_id: str, text: str):
+        await self.transcript_collection.update_one(
+            {"_id": file_unique_id},
+            {"$set": {"text": text, "created": datetime.now()}},
+            upsert=True
         )
@@ -0,0 +1,163 @@
+import logging
+
+import httpx
+import openai
+from telegram.request import HTTPXRequest
+
+import config
+import metrics
+
+
+logger = logging.getLogger(__name__)
+
+# per client; keys set under http_transport.<client> in config.yml override these
+DEFAULT_SETTINGS = {
+    "openai": {
+        "max_connections": 500,
+        "max_keepalive_connections": 100,
+        "keepalive_expiry": 60.0,
+        "http2": True,
+        "connect_timeout": 10.0,
+        "read_timeout": 120.0,  # max silence between two chunks of a streamed answer
+        "write_timeout": 30.0,
+        "pool_timeout": 30.0,
+    },
+    "openrouter": {
+        "max_connections": 500,
+        "max_keepalive_connections": 100,
+        "keepalive_expiry": 60.0,
+        "http2": True,
+        "connect_timeout": 10.0,
+        "read_timeout": 120.0,
+        "write_timeout": 30.0,
+        "pool_timeout": 30.0,
+    },
+    "telegram": {
+        "max_connections": 256,
+        "max_keepalive_connections": 64,
+        "keepalive_expiry": 30.0,
+        "http2": False,
+        "connect_timeout": 5.0,
+        "read_timeout": 10.0,
+        "write_timeout": 20.0,  # uploads of generated images
+        "pool_timeout": 5.0,
+    },
+}
+
+# client name -> httpx.AsyncClient, for pool stats
+_clients = {}
+
+
+def _has_http2():
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def get_settings(client_name):
+    settings = {**DEFAULT_SETTINGS[client_name], **(config.http_transport.get(client_name) or {})}
+    if settings["http2"] and not _has_http2():
+        logger.warning(f"HTTP/2 is enabled for {client_name} but the h2 package is missing, using HTTP/1.1")
+        settings["http2"] = False
+    return settings
+
+
+def get_limits(settings):
+    return httpx.Limits(
+        max_connections=settings["max_connections"],
+        max_keepalive_connections=settings["max_keepalive_connections"],
+        keepalive_expiry=settings["keepalive_expiry"],
+    )
+
+
+def get_timeout(settings):
+    return httpx.Timeout(
+        connect=settings["connect_timeout"],
+        read=settings["read_timeout"],
+        write=settings["write_timeout"],
+        pool=settings["pool_timeout"],
+    )
+
+
+def register_client(client_name, client: httpx.AsyncClient):
+    _clients[client_name] = client
+    for state in ("active", "idle", "http2"):
+        metrics.HTTP_POOL_CONNECTIONS.labels(client=client_name, state=state).set_function(
+            lambda state=state: get_pool_stats(client_name)[f"n_{state}_connections"]
+        )
+    metrics.HTTP_POOL_QUEUED_REQUESTS.labels(client=client_name).set_function(
+        lambda: get_pool_stats(client_name)["n_queued_requests"]
+    )
+
+
+def create_openai_http_client(client_name) -> httpx.AsyncClient:
+    """httpx client for an AsyncOpenAI client, with the pool and timeouts of `client_name`"""
+    settings = get_settings(client_name)
+    client = openai.DefaultAsyncHttpxClient(
+        limits=get_limits(settings),
+        timeout=get_timeout(settings),
+        http2=settings["http2"],
+    )
+    register_client(client_name, client)
+    return client
+
+
+class TelegramRequest(HTTPXRequest):
+    """HTTPXRequest with keepalive settings, and HTTP/2 that falls back to HTTP/1.1.
+
+    HTTPXRequest(http_version="2") turns HTTP/1.1 off, which breaks self-hosted
+    Bot API servers behind plain HTTP, and it ties keepalive connections to the
+    pool size. This one negotiates the version with the server instead.
+    """
+
+    def __init__(self, client_name="telegram"):
+        # read by _build_client(), which HTTPXRequest.__init__ calls
+        self._settings = get_settings(client_name)
+        super().__init__(
+            connection_pool_size=self._settings["max_connections"],
+            read_timeout=self._settings["read_timeout"],
+            write_timeout=self._settings["write_timeout"],
+            connect_timeout=self._settings["connect_timeout"],
+            pool_timeout=self._settings["pool_timeout"],
+        )
+        register_client(client_name, self._client)
+
+    def _build_client(self) -> httpx.AsyncClient:
+        client = httpx.AsyncClient(**{
+            **self._client_kwargs,
+            "limits": get_limits(self._settings),
+            "http1": True,
+            "http2": self._settings["http2"],
+        })
+        # rebuilt after shutdown()/initialize(), keep the stats pointing at the live client
+        if getattr(self, "_client", None) is not None:
+            for client_name, registered_client in _clients.items():
+                if registered_client is self._client:
+                    _clients[client_name] = client
+        return client
+
+
+def get_pool_stats(client_name):
+    """Connections of a client's pool by state, and requests waiting for one"""
+    stats = {"n_active_connections": 0, "n_idle_connections": 0, "n_http2_connections": 0, "n_queued_requests": 0}
+
+    # httpx does not expose its pool, read it from the transport
+    pool = getattr(getattr(_clients.get(client_name), "_transport", None), "_pool", None)
+    if pool is None:
+        return stats
+
+    for connection in pool.connections:
+        if connection.is_idle():
+            stats["n_idle_connections"] += 1
+        else:
+            stats["n_active_connections"] += 1
+        if "HTTP/2" in connection.info():
+            stats["n_http2_connections"] += 1
+    stats["n_queued_requests"] = sum(request.is_queued() for request in pool._requests)
+    return stats
+
+
+def get_all_pool_stats():
+    return {client_name: get_pool_stats(client_name) for client_name in _clients}
@@ -0,0 +1,108 @@
+import base64
+from io import BytesIO
+
+from PIL import Image
+
+import config
+import openai_utils
+
+
+# OpenAI scales high detail images to fit 2048x2048, then their shortest side down to 768
+DEFAULT_TARGET_SIZE = 768
+MAX_SIZE = 2048
+LOW_DETAIL_SIZE = 512  # low detail images are seen as 512x512
+JPEG_QUALITY = 85
+
+# Pillow format and save() options per generated_image_format
+GENERATED_IMAGE_FORMATS = {
+    "jpeg": ("JPEG", {"optimize": True}),
+    "webp": ("WEBP", {"method": 4}),
+}
+
+# JPEGs with up to this many times the pixels the model uses are sent as they are:
+# Telegram's photo sizes are that close already, and resizing costs more CPU than it saves bytes
+MAX_EXCESS_PIXELS = 2.0
+
+
+class PreparedImage:
+    """Image for a vision model: JPEG bytes at the resolution the model uses, and their base64"""
+
+    __slots__ = ("data", "width", "height", "detail", "base64")
+
+    def __init__(self, data: bytes, width: int, height: int, detail: str):
+        self.data = data
+        self.width = width
+        self.height = height
+        self.detail = detail
+        self.base64 = base64.b64encode(data).decode("ascii")
+
+
+def get_image_detail(width, height, model):
+    """"high" while the image fits the model's per-image token budget, else "low" (85 tokens)"""
+    token_budget = config.models["info"].get(model, {}).get("image_token_budget", config.vision_image_token_budget)
+    if token_budget is None or openai_utils.estimate_image_tokens(width, height) <= token_budget:
+        return "high"
+    return "low"
+
+
+def get_target_dimensions(width, height, model, detail):
+    """Size the model actually looks at, so sending more pixels only costs bytes"""
+    if detail == "low":
+        scale = min(1.0, LOW_DETAIL_SIZE / max(width, height))
+    else:
+        target_size = config.models["info"].get(model, {}).get("image_target_size", DEFAULT_TARGET_SIZE)
+        scale = min(1.0, MAX_SIZE / max(width, height), target_size / min(width, height))
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+
+def choose_photo_size(photo_sizes, model):
+    """Smallest of Telegram's sizes of a photo that still has the resolution the model uses"""
+    largest_photo_size = max(photo_sizes, key=lambda photo_size: photo_size.width * photo_size.height)
+    detail = get_image_detail(largest_photo_size.width, largest_photo_size.height, model)
+    target_width, target_height = get_target_dimensions(
+        largest_photo_size.width, largest_photo_size.height, model, detail
+    )
+
+    for photo_size in sorted(photo_sizes, key=lambda photo_size: photo_size.width * photo_size.height):
+        # Telegram's sizes may be a pixel off the original aspect ratio
+        if photo_size.width >= target_width - 1 and photo_size.height >= target_height - 1:
+            return photo_size
+    return largest_photo_size
+
+
+def prepare_image(data: bytes, model) -> PreparedImage:
+    """Downscales and re-encodes an image for the model; CPU-bound, run it in a thread"""
+    with Image.open(BytesIO(data)) as image:
+        width, height = image.size
+        detail = get_image_detail(width, height, model)
+        target_width, target_height = get_target_dimensions(width, height, model, detail)
+        if image.format == "JPEG" and width * height <= MAX_EXCESS_PIXELS * target_width * target_height:
+            return PreparedImage(data, width, height, detail)
+
+        image.draft("RGB", (target_width, target_height))  # JPEGs are decoded at a reduced scale
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        image = image.resize((target_width, target_height), Image.BICUBIC)
+
+        buf = BytesIO()
+        image.save(buf, format="JPEG", quality=JPEG_QUALITY)
+
+    return PreparedImage(buf.getvalue(), target_width, target_height, detail)
+
+
+def encode_generated_image(data: bytes, image_format: str, quality: int) -> bytes:
+    """Re-encodes a generated PNG as compressed JPEG or WebP for upload; CPU-bound, run it in a thread.
+
+    Telegram re-encodes photos to JPEG anyway, so uploading the PNG only costs
+    time. "png" returns the bytes unchanged.
+    """
+    if image_format == "png":
+        return data
+
+    pil_format, save_options = GENERATED_IMAGE_FORMATS[image_format]
+    with Image.open(BytesIO(data)) as image:
+        if image.mode != "RGB":
+            image = image.convert("RGB")
+        buf = BytesIO()
+        image.save(buf, format=pil_format, quality=quality, **save_options)
+    return buf.getvalue()
@@ -0,0 +1,152 @@
+import asyncio
+import contextlib
+import logging
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import pymongo
+
+
+logger = logging.getLogger(__name__)
+
+
+class _UserLock:
+    __slots__ = ("semaphore", "n_users")
+
+    def __init__(self):
+        self.semaphore = asyncio.Semaphore(1)
+        self.n_users = 0  # holder and waiters
+
+
+class LocalUserLocks:
+    """One message in flight per user, enforced within this process.
+
+    `lock()` serializes answers to the same user, `set_task()` registers the
+    task doing the answering so that `cancel()` (/cancel) can stop it. A user's
+    entry is dropped as soon as nobody holds or waits for the lock, so memory
+    is bounded by the number of concurrently active users, not by all users
+    ever seen.
+    """
+
+    def __init__(self):
+        self._locks = {}  # user_id -> _UserLock, only while held or awaited
+        self._tasks = {}  # user_id -> task answering the user in this process
+
+    def __len__(self):
+        return len(self._locks)
+
+    async def is_locked(self, user_id: int) -> bool:
+        user_lock = self._locks.get(user_id)
+        return user_lock is not None and user_lock.semaphore.locked()
+
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id: int):
+        user_lock = self._locks.get(user_id)
+        if user_lock is None:
+            user_lock = self._locks[user_id] = _UserLock()
+
+        user_lock.n_users += 1
+        try:
+            async with user_lock.semaphore:
+                try:
+                    yield
+                finally:
+                    self._tasks.pop(user_id, None)
+        finally:
+            user_lock.n_users -= 1
+            if user_lock.n_users == 0:
+                del self._locks[user_id]
+
+    def set_task(self, user_id: int, task: asyncio.Task):
+        self._tasks[user_id] = task
+
+    async def cancel(self, user_id: int) -> bool:
+        task = self._tasks.get(user_id)
+        if task is None:
+            return False
+
+        task.cancel()
+        return True
+
+
+class MongoUserLocks(LocalUserLocks):
+    """One message in flight per user across all bot processes sharing a MongoDB.
+
+    The lock is a lease document {_id: user_id, owner, expires_at, cancel}. Its
+    holder renews it every `heartbeat_interval` seconds, and reads the cancel
+    flag set by /cancel in any process with the same round trip, so a streamed
+    answer stops within one heartbeat. A holder that dies without releasing its
+    lease blocks the user for at most `lease_ttl` seconds.
+    """
+
+    def __init__(self, collection, lease_ttl: float = 30.0, heartbeat_interval: float = 1.0):
+        super().__init__()
+        self._collection = collection
+        self.lease_ttl = timedelta(seconds=lease_ttl)
+        self.heartbeat_interval = heartbeat_interval
+
+    @staticmethod
+    def _now():
+        return datetime.now(timezone.utc)
+
+    async def is_locked(self, user_id: int) -> bool:
+        if await super().is_locked(user_id):
+            return True
+        return await self._collection.count_documents({"_id": user_id, "expires_at": {"$gt": self._now()}}) > 0
+
+    async def _try_acquire(self, user_id: int, owner: str) -> bool:
+        now = self._now()
+        try:
+            # matches a missing (upsert) or expired lease; a live one makes the upsert fail on _id
+            await self._collection.update_one(
+                {"_id": user_id, "expires_at": {"$lt": now}},
+                {"$set": {"owner": owner, "expires_at": now + self.lease_ttl, "cancel": False}},
+                upsert=True
+            )
+        except pymongo.errors.DuplicateKeyError:
+            return False
+        return True
+
+    async def _heartbeat(self, user_id: int, owner: str):
+        while True:
+            await asyncio.sleep(self.heartbeat_interval)
+
+            lease = await self._collection.find_one_and_update(
+                {"_id": user_id, "owner": owner},
+                {"$set": {"expires_at": self._now() + self.lease_ttl}}
+            )
+            if lease is None:
+                logger.warning(f"Lost the lock of user {user_id}, cancelling the answer")
+
+            if lease is None or lease["cancel"]:
+                task = self._tasks.get(user_id)
+                if task is not None:
+                    task.cancel()
+                return
+
+    @contextlib.asynccontextmanager
+    async def lock(self, user_id: int):
+        # local waiters queue on the semaphore, so only one of them polls MongoDB
+        async with super().lock(user_id):
+            owner = uuid.uuid4().hex
+            while not await self._try_acquire(user_id, owner):
+                await asyncio.sleep(self.heartbeat_interval)
+
+            heartbeat_task = asyncio.create_task(self._heartbeat(user_id, owner))
+            try:
+                yield
+            finally:
+                heartbeat_task.cancel()
+                await asyncio.gather(heartbeat_task, return_exceptions=True)
+                await self._collection.delete_one({"_id": user_id, "owner": owner})
+
+    async def cancel(self, user_id: int) -> bool:
+        if await super().cancel(user_id):
+            return True
+
+        # the answer is running in another process: its heartbeat picks the flag up
+        lease = await self._collection.find_one_and_update(
+            {"_id": user_id, "expires_at": {"$gt": self._now()}},
+            {"$set": {"cancel": True}}
+        )
+        return lease is not None
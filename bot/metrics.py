@@ -0,0 +1,130 @@
+import functools
+import logging
+import time
+
+from prometheus_client import Counter, Gauge, Histogram, start_http_server
+
+
+logger = logging.getLogger(__name__)
+
+# completions take seconds, everything else (Mongo, Telegram, queues) milliseconds
+COMPLETION_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 4.0, 8.0, 15.0, 30.0, 60.0, 120.0)
+FAST_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+CHATGPT_TIME_TO_FIRST_TOKEN = Histogram(
+    "chatgpt_time_to_first_token_seconds",
+    "Time from sending a streamed completion request to its first content token",
+    ["model", "provider", "chat_mode"],
+    buckets=COMPLETION_BUCKETS,
+)
+CHATGPT_COMPLETION_DURATION = Histogram(
+    "chatgpt_completion_duration_seconds",
+    "Total time of a completion request, until the last token",
+    ["model", "provider", "chat_mode"],
+    buckets=COMPLETION_BUCKETS,
+)
+CHATGPT_INPUT_TOKENS = Counter(
+    "chatgpt_input_tokens",
+    "Prompt tokens of completions, by whether the provider read them from its prompt cache",
+    ["model", "cache"],
+)
+DATABASE_OPERATION_DURATION = Histogram(
+    "database_operation_duration_seconds",
+    "Duration of Database methods",
+    ["method"],
+    buckets=FAST_BUCKETS,
+)
+TELEGRAM_EDIT_DURATION = Histogram(
+    "telegram_edit_message_duration_seconds",
+    "Duration of edit_message_text calls for streamed answers",
+    ["chat_type"],
+    buckets=FAST_BUCKETS,
+)
+QUEUE_WAIT_DURATION = Histogram(
+    "queue_wait_seconds",
+    "Time spent waiting for a turn: the user's message lock, a Telegram edit slot or an upstream request slot",
+    ["queue"],
+    buckets=FAST_BUCKETS,
+)
+TRANSCRIBE_AUDIO_DURATION = Histogram(
+    "openai_transcribe_audio_duration_seconds",
+    "Duration of voice message transcriptions",
+    buckets=COMPLETION_BUCKETS,
+)
+GENERATE_IMAGES_DURATION = Histogram(
+    "openai_generate_images_duration_seconds",
+    "Duration of image generation requests",
+    buckets=COMPLETION_BUCKETS,
+)
+USER_LOCKS = Gauge(
+    "user_locks",
+    "Users whose per-user lock is held or awaited in this process",
+)
+UPSTREAM_ROUTE_ATTEMPTS = Counter(
+    "upstream_route_attempts",
+    "Completion requests per route of a model: won, failed, or cancelled after another route won",
+    ["model", "provider", "outcome"],
+)
+UPSTREAM_PROVIDER_STATE = Gauge(
+    "upstream_provider_circuit_state",
+    "Circuit breaker of a provider: 0 closed, 1 half-open (probing), 2 open (failing fast)",
+    ["provider"],
+)
+UPSTREAM_PROVIDER_ERROR_RATE = Gauge(
+    "upstream_provider_error_rate",
+    "Share of a provider's requests that failed within the circuit breaker window",
+    ["provider"],
+)
+UPSTREAM_PROVIDER_TIME_TO_FIRST_TOKEN = Gauge(
+    "upstream_provider_time_to_first_token_seconds",
+    "Median time to first token of a provider within the circuit breaker window",
+    ["provider"],
+)
+UPSTREAM_STREAM_STALLS = Counter(
+    "upstream_stream_stalls",
+    "Streamed completions aborted because no data arrived for stream_stall_timeout seconds",
+    ["provider"],
+)
+COMPLETION_CACHE_LOOKUPS = Counter(
+    "completion_cache_lookups",
+    "Lookups of first-turn answers in the completion cache, by whether the answer was cached",
+    ["model", "result"],
+)
+DIALOG_COMPACTIONS = Counter(
+    "dialog_compactions",
+    "Background dialog summarizations: stored, discarded because the dialog changed meanwhile, or failed",
+    ["outcome"],
+)
+HTTP_POOL_CONNECTIONS = Gauge(
+    "http_pool_connections",
+    "Open connections of an API client's pool: active, idle, and how many of them speak HTTP/2",
+    ["client", "state"],
+)
+HTTP_POOL_QUEUED_REQUESTS = Gauge(
+    "http_pool_queued_requests",
+    "Requests of an API client waiting for a free pool connection",
+    ["client"],
+)
+
+
+def timed(histogram, **labels):
+    """Decorator that observes the duration of an async function, also when it raises"""
+    def decorator(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            start_time = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            finally:
+                metric = histogram.labels(**labels) if labels else histogram
+                metric.observe(time.perf_counter() - start_time)
+
+        return wrapper
+
+    return decorator
+
+
+def start_server(port: int, addr: str = "0.0.0.0"):
+    """Serves /metrics from a daemon thread, so scrapes never block the event loop"""
+    start_http_server(port, addr=addr)
+    logger.info(f"Serving metrics on {addr}:{port}")
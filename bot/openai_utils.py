@@ -1,16 +1,29 @@
+import asyncio
 import base64
-from io import BytesIO
+import contextlib
+import hashlib
+import json
+import math
+import os
+import re
+import time
+from collections import OrderedDict, defaultdict, deque
+from io import StringIO
 import config
+import http_transport
 import logging
+import metrics
 
 import tiktoken
-from openai import AsyncOpenAI, BadRequestError
+import openai
+from openai import AsyncOpenAI
 
 
 # setup openai client
 openai_client = AsyncOpenAI(
     api_key=config.openai_api_key,
     base_url=config.openai_api_base,
+    http_client=http_transport.create_openai_http_client("openai"),
 )
 
 # optional OpenRouter client (OpenAI-compatible) for models declared with
@@ -20,21 +33,153 @@ if config.openrouter_api_key:
     openrouter_client = AsyncOpenAI(
         api_key=config.openrouter_api_key,
         base_url=config.openrouter_api_base,
+        http_client=http_transport.create_openai_http_client("openrouter"),
     )
 
 logger = logging.getLogger(__name__)
 
+# load BPE files from a local directory (populated at image build time), so
+# token counting never has to reach the network
+if config.tiktoken_cache_dir:
+    os.environ["TIKTOKEN_CACHE_DIR"] = str(config.tiktoken_cache_dir)
 
-def _get_client_for_model(model):
-    provider = config.models["info"].get(model, {}).get("provider", "openai")
-    if provider == "openrouter":
-        if openrouter_client is None:
-            raise ValueError(
-                "OpenRouter API key is not configured. "
-                "Set openrouter_api_key in config/config.yml"
+DEFAULT_ENCODING_NAME = "o200k_base"
+
+# model -> tiktoken encoding, filled by prewarm_encodings() at startup
+_encodings = {}
+
+
+def get_encoding_name(model):
+    tokenizer = config.models["info"].get(model, {}).get("tokenizer")
+    if tokenizer is not None:
+        return tokenizer
+
+    try:
+        return tiktoken.encoding_name_for_model(model)
+    except KeyError:
+        # models not known to tiktoken (e.g. Claude or other models routed
+        # via OpenRouter) fall back to a modern encoding for an estimate
+        return DEFAULT_ENCODING_NAME
+
+
+def get_encoding(model):
+    encoding = _encodings.get(model)
+    if encoding is None:
+        encoding = _encodings[model] = tiktoken.get_encoding(get_encoding_name(model))
+    return encoding
+
+
+def prewarm_encodings():
+    """Loads the encodings of all chat models and counts the chat mode prompts,
+    so the first request doesn't pay for it"""
+    for model, model_info in config.models["info"].items():
+        if model_info.get("type") == "chat_completion":
+            get_encoding(model)
+            for chat_mode, chat_mode_info in config.chat_modes.items():
+                if "prompt_start" in chat_mode_info:  # e.g. artist has no prompt
+                    count_system_prompt_tokens(chat_mode, model)
+
+
+# all currently supported chat models (gpt-4o, gpt-4o-mini, gpt-5.5,
+# Claude, ...) use the same per-message overhead
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_REPLY = 2
+
+# share of the context window the prompt may fill, leaving headroom for
+# providers whose tokenizers count more tokens than our tiktoken estimate
+CONTEXT_WINDOW_USAGE = 0.9
+
+# (chat_mode, model) -> tokens of the chat mode's system message
+_system_prompt_n_tokens = {}
+
+
+def count_system_prompt_tokens(chat_mode, model):
+    key = (chat_mode, model)
+    if key not in _system_prompt_n_tokens:
+        prompt = config.chat_modes[chat_mode]["prompt_start"]
+        _system_prompt_n_tokens[key] = TOKENS_PER_MESSAGE + len(get_encoding(model).encode(prompt))
+    return _system_prompt_n_tokens[key]
+
+
+def estimate_image_tokens(width, height, detail="high"):
+    """Token cost of an image input, following OpenAI's tile-based formula"""
+    if detail == "low":
+        return 85
+
+    # fit into 2048x2048, then scale the shortest side down to 768
+    scale = min(1.0, 2048 / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, 768 / min(width, height))
+    width, height = width * scale, height * scale
+
+    n_tiles = math.ceil(width / 512) * math.ceil(height / 512)
+    return 85 + 170 * n_tiles
+
+
+# used when an image's dimensions are unknown (1024x1024, high detail)
+DEFAULT_IMAGE_TOKENS = estimate_image_tokens(1024, 1024)
+
+
+def _count_content_tokens(content, encoding):
+    if not isinstance(content, list):
+        return len(encoding.encode(content))
+
+    n_tokens = 0
+    for part in content:
+        if part["type"] == "text":
+            n_tokens += len(encoding.encode(part["text"]))
+        elif part["type"] == "image" and "width" in part:
+            n_tokens += estimate_image_tokens(part["width"], part["height"], part.get("detail", "high"))
+        elif part["type"] in ("image", "image_url"):
+            n_tokens += DEFAULT_IMAGE_TOKENS
+    return n_tokens
+
+
+def _count_image_tokens(content):
+    if not isinstance(content, list):
+        return 0
+
+    n_tokens = 0
+    for part in content:
+        if part["type"] == "image":
+            n_tokens += (
+                estimate_image_tokens(part["width"], part["height"], part.get("detail", "high"))
+                if "width" in part else DEFAULT_IMAGE_TOKENS
             )
-        return openrouter_client
-    return openai_client
+    return n_tokens
+
+
+def _strip_images(dialog_message):
+    if not isinstance(dialog_message["user"], list):
+        return dialog_message
+    return {**dialog_message, "user": [part for part in dialog_message["user"] if part["type"] != "image"]}
+
+
+def get_dialog_message_text(content):
+    """Text of a stored user turn, with images as placeholders"""
+    if not isinstance(content, list):
+        return content
+    return "\n".join(part["text"] if part["type"] == "text" else "[image]" for part in content)
+
+
+def count_dialog_message_tokens(dialog_message, model):
+    """Tokens a stored dialog message (user turn + bot answer) takes in a prompt"""
+    encoding = get_encoding(model)
+    return (
+        2 * TOKENS_PER_MESSAGE
+        + _count_content_tokens(dialog_message["user"], encoding)
+        + len(encoding.encode(dialog_message["bot"]))
+    )
+
+
+def get_n_cached_input_tokens(usage) -> int:
+    """Prompt tokens the provider read from its prompt cache (OpenAI, and OpenRouter for all providers)"""
+    prompt_tokens_details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(prompt_tokens_details, "cached_tokens", None) or 0
+
+
+def get_provider(model):
+    return config.models["info"].get(model, {}).get("provider", "openai")
 
 
 OPENAI_COMPLETION_OPTIONS = {
@@ -43,136 +188,616 @@ OPENAI_COMPLETION_OPTIONS = {
     "top_p": 1,
     "frequency_penalty": 0,
     "presence_penalty": 0,
-    "timeout": 60.0,
 }
 
 
+DIALOG_SUMMARY_PROMPT = (
+    "You maintain a running summary of a conversation between a user and an AI assistant. "
+    "Merge the previous summary (if any) and the new turns into one updated summary. Keep facts "
+    "about the user, their goals, decisions made, open questions, and any names, numbers or code "
+    "the conversation may refer back to. Write it in the language of the conversation, as plain "
+    "text of at most 300 words, without any preamble."
+)
+DIALOG_SUMMARY_HEADER = "Summary of the earlier part of this conversation:"
+
+CACHE_CONTROL = {"type": "ephemeral"}
+
+
+def get_dialog_summary_text(summary_text):
+    """The dialog summary as it is sent, after the chat mode prompt"""
+    return f"{DIALOG_SUMMARY_HEADER}\n{summary_text}"
+
+
+def _add_cache_breakpoints(messages):
+    """Marks prompt cache breakpoints for models with `cache_control: true` in models.yml.
+
+    Anthropic models (through OpenRouter) cache a prompt only up to content
+    parts marked with cache_control, at most 4 per request. The chat mode
+    prompt, the dialog summary and the newest message are marked: the next
+    turn starts with this whole prompt and reads it from the cache. OpenAI
+    caches prompt prefixes without any marks. Modifies `messages`, which
+    must be freshly built.
+    """
+    system_message, last_message = messages[0], messages[-1]
+    for message in (system_message, last_message):
+        if not isinstance(message["content"], list):
+            message["content"] = [{"type": "text", "text": message["content"]}]
+
+    parts_to_mark = [(system_message, i) for i in range(len(system_message["content"]))]
+    parts_to_mark.append((last_message, len(last_message["content"]) - 1))
+    for message, i in parts_to_mark:
+        message["content"][i] = {**message["content"][i], "cache_control": CACHE_CONTROL}
+
+
+class CompletionCache:
+    """Exact-match cache of first-turn answers, with LRU and TTL eviction"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()  # key -> (expiration time, answer)
+
+    @staticmethod
+    def get_key(model, chat_mode, message, completion_options) -> str:
+        normalized_message = re.sub(r"\s+", " ", message).strip()
+        key_data = [model, chat_mode, normalized_message, completion_options]
+        return hashlib.sha256(json.dumps(key_data, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is not None and entry[0] < time.monotonic():
+            del self._entries[key]
+            entry = None
+
+        if entry is None:
+            return None
+
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def put(self, key, answer):
+        self._entries[key] = (time.monotonic() + self.ttl, answer)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+
+completion_cache = CompletionCache(config.completion_cache_size, config.completion_cache_ttl)
+
+
+class UpstreamOverloadedError(Exception):
+    pass
+
+
+class _UpstreamWaiter:
+    __slots__ = ("provider", "model", "future", "on_queue_position", "queue_position")
+
+    def __init__(self, provider, model, on_queue_position):
+        self.provider = provider
+        self.model = model
+        self.future = asyncio.get_running_loop().create_future()
+        self.on_queue_position = on_queue_position
+        self.queue_position = None
+
+
+class UpstreamScheduler:
+    """Caps concurrent completion requests per provider and per model.
+
+    Requests over a cap wait in per-user queues that are served round-robin,
+    so a burst from one user can't starve the others. When more than
+    `max_queue_size` requests already wait for a provider, new ones fail at
+    once with UpstreamOverloadedError instead of piling up into timeouts,
+    429s and retries.
+    """
+
+    def __init__(self, provider_limits: dict, model_limits: dict, max_queue_size: int):
+        self.provider_limits = provider_limits  # provider -> max concurrent requests, missing = unlimited
+        self.model_limits = model_limits  # model -> max concurrent requests, missing = unlimited
+        self.max_queue_size = max_queue_size
+
+        self._n_running_per_provider = defaultdict(int)
+        self._n_running_per_model = defaultdict(int)
+        self._n_waiting_per_provider = defaultdict(int)
+        self._queues = OrderedDict()  # user_id -> deque of waiters, in round-robin order
+
+    def _has_capacity(self, provider, model):
+        return (
+            self._n_running_per_provider[provider] < self.provider_limits.get(provider, math.inf)
+            and self._n_running_per_model[model] < self.model_limits.get(model, math.inf)
+        )
+
+    def _dispatch(self):
+        # each round grants at most one request per user
+        is_granted = True
+        while is_granted:
+            is_granted = False
+            for user_id in list(self._queues):
+                waiters = self._queues[user_id]
+                # drop waiters cancelled since the last dispatch, their slot() has not run yet to remove them
+                while waiters and waiters[0].future.done():
+                    self._n_waiting_per_provider[waiters.popleft().provider] -= 1
+                if not waiters:
+                    del self._queues[user_id]
+                    continue
+
+                waiter = waiters[0]
+                if not self._has_capacity(waiter.provider, waiter.model):
+                    continue
+
+                waiters.popleft()
+                if waiters:
+                    self._queues.move_to_end(user_id)
+                else:
+                    del self._queues[user_id]
+
+                self._n_waiting_per_provider[waiter.provider] -= 1
+                self._n_running_per_provider[waiter.provider] += 1
+                self._n_running_per_model[waiter.model] += 1
+                waiter.future.set_result(None)
+                is_granted = True
+
+        self._notify_queue_positions()
+
+    def _notify_queue_positions(self):
+        queue_positions = defaultdict(int)
+        for waiters in self._queues.values():
+            for waiter in waiters:
+                queue_positions[waiter.provider] += 1
+                queue_position = queue_positions[waiter.provider]
+                if waiter.on_queue_position is not None and waiter.queue_position != queue_position:
+                    waiter.queue_position = queue_position
+                    waiter.on_queue_position(queue_position)
+
+    def _remove(self, user_id, waiter):
+        waiters = self._queues.get(user_id)
+        if waiters is None or waiter not in waiters:  # already dropped by _dispatch
+            return
+        waiters.remove(waiter)
+        if not waiters:
+            del self._queues[user_id]
+        self._n_waiting_per_provider[waiter.provider] -= 1
+
+    def _release(self, provider, model):
+        self._n_running_per_provider[provider] -= 1
+        self._n_running_per_model[model] -= 1
+        self._dispatch()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, provider, model, user_id=None, on_queue_position=None):
+        """Holds one request slot of the provider and the model while the block runs.
+
+        `on_queue_position(position)` is called whenever the 1-based position
+        among the requests waiting for the same provider changes.
+        """
+        waiter = _UpstreamWaiter(provider, model, on_queue_position)
+        self._queues.setdefault(user_id, deque()).append(waiter)
+        self._n_waiting_per_provider[provider] += 1
+        self._dispatch()
+
+        if not waiter.future.done():
+            if self._n_waiting_per_provider[provider] > self.max_queue_size:
+                self._remove(user_id, waiter)
+                raise UpstreamOverloadedError(f"Too many requests are waiting for {provider}")
+
+            start_time = time.perf_counter()
+            try:
+                await waiter.future
+            except asyncio.CancelledError:
+                if waiter.future.cancelled():
+                    self._remove(user_id, waiter)
+                    self._notify_queue_positions()
+                else:  # cancelled right after the slot was granted
+                    self._release(provider, model)
+                raise
+            metrics.QUEUE_WAIT_DURATION.labels(queue="upstream").observe(time.perf_counter() - start_time)
+
+        try:
+            yield
+        finally:
+            self._release(provider, model)
+
+
+upstream_scheduler = UpstreamScheduler(
+    config.upstream_max_concurrent_requests,
+    {
+        model: model_info["max_concurrent_requests"]
+        for model, model_info in config.models["info"].items() if "max_concurrent_requests" in model_info
+    },
+    config.upstream_max_queue_size,
+)
+
+
+def _get_client(provider):
+    if provider == "openrouter":
+        if openrouter_client is None:
+            raise ValueError(
+                "OpenRouter API key is not configured. "
+                "Set openrouter_api_key in config/config.yml"
+            )
+        return openrouter_client
+    return openai_client
+
+
+def get_routes(model):
+    """(provider, model name at the provider) pairs to request a model through, in order.
+
+    models.yml lists them under "routes", e.g. gpt-4o directly and through
+    OpenRouter; without "routes" the model's own provider is the only route.
+    Fallback routes through a provider without an API key are skipped.
+    """
+    model_info = config.models["info"].get(model, {})
+    routes = [
+        (route.get("provider", "openai"), route.get("model", model))
+        for route in model_info.get("routes", [])
+    ] or [(get_provider(model), model)]
+
+    available_routes = [route for route in routes if route[0] != "openrouter" or openrouter_client is not None]
+    if not available_routes:
+        _get_client(routes[0][0])  # raises the missing API key error
+    return available_routes
+
+
+def get_hedge_delay(model):
+    return config.models["info"].get(model, {}).get("hedge_delay", config.upstream_hedge_delay)
+
+
+class ProviderUnavailableError(Exception):
+    pass
+
+
+class StreamStalledError(Exception):
+    pass
+
+
+# errors that count against a provider's health
+PROVIDER_ERRORS = (
+    openai.APIConnectionError,  # includes timeouts
+    openai.RateLimitError,
+    openai.InternalServerError,
+    StreamStalledError,
+)
+
+# errors after which the next route is tried; others (e.g. a bad request) would fail on every route
+FAILOVER_ERRORS = PROVIDER_ERRORS + (UpstreamOverloadedError, ProviderUnavailableError)
+
+
+class ProviderHealth:
+    """Rolling error rate and time to first token of a provider, with a circuit breaker.
+
+    The breaker opens when at least `min_requests` requests finished within the
+    last `window` seconds and more than `max_error_rate` of them failed. While
+    it is open, requests fail at once with ProviderUnavailableError, which sends
+    them to the model's next route. After `cooldown` seconds a single probe
+    request is let through (half-open): its success closes the breaker, its
+    failure opens it again.
+    """
+
+    CLOSED, HALF_OPEN, OPEN = "closed", "half_open", "open"
+    STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+    def __init__(self, provider, window: float, max_error_rate: float, min_requests: int, cooldown: float):
+        self.provider = provider
+        self.window = window
+        self.max_error_rate = max_error_rate
+        self.min_requests = min_requests
+        self.cooldown = cooldown
+
+        self.state = self.CLOSED
+        self._opened_time = None
+        self._is_probing = False
+        self._outcomes = deque()  # (time, is_error) of requests within the window
+        self._first_token_times = deque()  # (time, seconds to the first token)
+
+        metrics.UPSTREAM_PROVIDER_STATE.labels(provider=provider).set(self.STATE_VALUES[self.state])
+        metrics.UPSTREAM_PROVIDER_ERROR_RATE.labels(provider=provider).set_function(lambda: self.error_rate)
+        metrics.UPSTREAM_PROVIDER_TIME_TO_FIRST_TOKEN.labels(provider=provider).set_function(
+            lambda: self.median_time_to_first_token or 0.0
+        )
+
+    def _trim(self):
+        min_time = time.monotonic() - self.window
+        for samples in (self._outcomes, self._first_token_times):
+            while samples and samples[0][0] < min_time:
+                samples.popleft()
+
+    @property
+    def error_rate(self) -> float:
+        self._trim()
+        if not self._outcomes:
+            return 0.0
+        return sum(is_error for _, is_error in self._outcomes) / len(self._outcomes)
+
+    @property
+    def median_time_to_first_token(self):
+        self._trim()
+        if not self._first_token_times:
+            return None
+        times = sorted(seconds for _, seconds in self._first_token_times)
+        return times[len(times) // 2]
+
+    def _set_state(self, state):
+        if state == self.state:
+            return
+
+        log = logger.info if state == self.CLOSED else logger.warning
+        log(f"Circuit breaker of {self.provider}: {self.state} -> {state} (error rate {self.error_rate:.0%})")
+        self.state = state
+        if state == self.OPEN:
+            self._opened_time = time.monotonic()
+        metrics.UPSTREAM_PROVIDER_STATE.labels(provider=self.provider).set(self.STATE_VALUES[state])
+
+    def _admit(self) -> bool:
+        """Raises ProviderUnavailableError or returns whether the request is the probe"""
+        if self.state == self.OPEN and time.monotonic() - self._opened_time >= self.cooldown:
+            self._set_state(self.HALF_OPEN)
+
+        if self.state == self.OPEN or (self.state == self.HALF_OPEN and self._is_probing):
+            raise ProviderUnavailableError(f"{self.provider} is unavailable, its circuit breaker is open")
+        if self.state == self.HALF_OPEN:
+            self._is_probing = True
+            return True
+        return False
+
+    def record_outcome(self, is_error: bool, is_probe: bool = False):
+        self._outcomes.append((time.monotonic(), is_error))
+        self._trim()
+
+        if self.state == self.HALF_OPEN:
+            if is_probe:  # requests sent before the breaker opened don't decide
+                self._set_state(self.OPEN if is_error else self.CLOSED)
+        elif self.state == self.CLOSED and len(self._outcomes) >= self.min_requests and self.error_rate > self.max_error_rate:
+            self._set_state(self.OPEN)
+
+    def record_time_to_first_token(self, seconds: float):
+        self._first_token_times.append((time.monotonic(), seconds))
+
+    @contextlib.contextmanager
+    def request(self):
+        """Admits a request, or raises ProviderUnavailableError while the breaker is open.
+
+        PROVIDER_ERRORS raised in the block count as failures and a normal exit
+        as a success. Cancellations and other errors (e.g. a bad request) are
+        not the provider's fault and count as neither.
+        """
+        is_probe = self._admit()
+        is_error = None
+        try:
+            yield
+            is_error = False
+        except PROVIDER_ERRORS:
+            is_error = True
+            raise
+        finally:
+            if is_probe:
+                self._is_probing = False
+            if is_error is not None:
+                self.record_outcome(is_error, is_probe)
+
+
+_provider_health = {}
+
+
+def get_provider_health(provider) -> ProviderHealth:
+    provider_health = _provider_health.get(provider)
+    if provider_health is None:
+        provider_health = _provider_health[provider] = ProviderHealth(
+            provider,
+            window=config.circuit_breaker_window,
+            max_error_rate=config.circuit_breaker_error_rate,
+            min_requests=config.circuit_breaker_min_requests,
+            cooldown=config.circuit_breaker_cooldown,
+        )
+    return provider_health
+
+
+async def _watch_stalls(async_iterator, timeout, provider):
+    """Raises StreamStalledError when the stream yields nothing for `timeout` seconds"""
+    while True:
+        try:
+            item = await asyncio.wait_for(anext(async_iterator), timeout)
+        except StopAsyncIteration:
+            return
+        except asyncio.TimeoutError:
+            metrics.UPSTREAM_STREAM_STALLS.labels(provider=provider).inc()
+            raise StreamStalledError(f"No data from {provider} for {timeout} s") from None
+        yield item
+
+
+async def _resume_stream(first_items, async_iterator):
+    """The already read first chunks, then the rest of the stream (which raises StreamStalledError on a stall)"""
+    for item in first_items:
+        yield item
+
+    async for item in async_iterator:
+        yield item
+
+
+class _StreamTokenCounter:
+    """Token counts of a streamed completion, updated incrementally.
+
+    The prompt is counted once; each delta is encoded on its own and appended to a
+    buffer, so the per-chunk cost does not grow with the answer. Counts are replaced
+    by the provider's exact `usage` when the stream reports it, which also
+    tells how many prompt tokens were cached.
+    """
+
+    def __init__(self, encoding, n_input_tokens: int):
+        self._encoding = encoding
+        self._buffer = StringIO()
+
+        self.n_input_tokens = n_input_tokens
+        self.n_output_tokens = 1
+        self.n_cached_input_tokens = 0
+
+    def add(self, text: str):
+        self._buffer.write(text)
+        self.n_output_tokens += len(self._encoding.encode(text))
+
+    def reconcile(self, usage):
+        self.n_input_tokens, self.n_output_tokens = usage.prompt_tokens, usage.completion_tokens
+        self.n_cached_input_tokens = get_n_cached_input_tokens(usage)
+
+    @property
+    def text(self) -> str:
+        return self._buffer.getvalue()
+
+
 class ChatGPT:
-    def __init__(self, model="gpt-4o-mini"):
+    def __init__(self, model="gpt-4o-mini", blob_store=None, user_id=None):
         assert model in config.models["info"], f"Unknown model: {model}"
         self.model = model
-        self._client = _get_client_for_model(model)
+        self.routes = get_routes(model)
+        self.user_id = user_id  # upstream requests are queued fairly per user
+        self._blob_store = blob_store  # loads images referenced by dialog messages
 
-    async def send_message(self, message, dialog_messages=[], chat_mode="assistant"):
+    async def send_message(self, message, dialog_messages=[], chat_mode="assistant", on_queue_position=None, dialog_summary=None):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if config.models["info"][self.model]["type"] == "chat_completion":
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
-
-                    r = await self._client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message.content
-                else:
-                    raise ValueError(f"Unknown model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
-            except BadRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError("Dialog messages is reduced to zero, but still has too many tokens to make completion") from e
+        if config.models["info"][self.model]["type"] != "chat_completion":
+            raise ValueError(f"Unknown model: {self.model}")
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        cache_key = self._get_completion_cache_key(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+        answer = self._get_cached_answer(cache_key)
+        if answer is not None:
+            return answer, (0, 0, 0), 0
 
+        n_dialog_messages_before = len(dialog_messages)
+        dialog_messages, _ = self._fit_dialog_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
         n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-        return answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+        dialog_images = await self._load_dialog_images(dialog_messages)
+        messages = self._generate_prompt_messages(
+            message, dialog_messages, chat_mode, dialog_images=dialog_images, dialog_summary=dialog_summary
+        )
+        _, r, _ = await self._start_hedged(
+            lambda provider, model, on_queue_position: self._create_completion(provider, model, messages, chat_mode, on_queue_position),
+            on_queue_position,
+            hedge=False,
+        )
+        answer = self._postprocess_answer(r.choices[0].message.content)
+        n_input_tokens, n_output_tokens = r.usage.prompt_tokens, r.usage.completion_tokens
+        n_cached_input_tokens = get_n_cached_input_tokens(r.usage)
+        self._count_prompt_cache_usage(n_input_tokens, n_cached_input_tokens)
+
+        if cache_key is not None:
+            completion_cache.put(cache_key, answer)
 
-    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant"):
+        return answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed
+
+    async def send_message_stream(self, message, dialog_messages=[], chat_mode="assistant", on_queue_position=None, dialog_summary=None):
         if chat_mode not in config.chat_modes.keys():
             raise ValueError(f"Chat mode {chat_mode} is not supported")
 
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if config.models["info"][self.model]["type"] == "chat_completion":
-                    messages = self._generate_prompt_messages(message, dialog_messages, chat_mode)
+        if config.models["info"][self.model]["type"] != "chat_completion":
+            raise ValueError(f"Unknown model: {self.model}")
 
-                    r_gen = await self._client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
+        cache_key = self._get_completion_cache_key(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+        answer = self._get_cached_answer(cache_key)
+        if answer is not None:
+            yield "finished", answer, (0, 0, 0), 0
+            return
 
-                    answer = ""
-                    async for r_item in r_gen:
-                        if len(r_item.choices) == 0:
-                            continue
-                        delta = r_item.choices[0].delta
+        n_dialog_messages_before = len(dialog_messages)
+        dialog_messages, n_input_tokens = self._fit_dialog_messages(message, dialog_messages, chat_mode, dialog_summary=dialog_summary)
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(dialog_messages)
 
-                        if delta.content:
-                            answer += delta.content
-                            n_input_tokens, n_output_tokens = self._count_tokens_from_messages(messages, answer, model=self.model)
-                            n_first_dialog_messages_removed = 0
+        dialog_images = await self._load_dialog_images(dialog_messages)
+        messages = self._generate_prompt_messages(
+            message, dialog_messages, chat_mode, dialog_images=dialog_images, dialog_summary=dialog_summary
+        )
+        token_counter = _StreamTokenCounter(get_encoding(self.model), n_input_tokens)
+        (provider, _), (r_items, start_time), exit_stack = await self._start_hedged(
+            lambda provider, model, on_queue_position: self._open_completion_stream(provider, model, messages, chat_mode, on_queue_position),
+            on_queue_position,
+        )
+        answer = ""
+        is_interrupted = False
+        try:
+            async with exit_stack:  # the winning route's request slot and HTTP stream
+                async for r_item in r_items:
+                    if r_item.usage is not None:
+                        token_counter.reconcile(r_item.usage)
+                    if len(r_item.choices) == 0:
+                        continue
+                    delta = r_item.choices[0].delta
 
-                            yield "not_finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed
+                    if delta.content:
+                        token_counter.add(delta.content)
+                        answer = token_counter.text
+                        n_input_tokens, n_output_tokens = token_counter.n_input_tokens, token_counter.n_output_tokens
+                        n_cached_input_tokens = token_counter.n_cached_input_tokens
 
-                answer = self._postprocess_answer(answer)
+                        yield "not_finished", answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed
 
-            except BadRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
+                self._get_metric(metrics.CHATGPT_COMPLETION_DURATION, chat_mode, provider).observe(time.perf_counter() - start_time)
+        except StreamStalledError as e:
+            logger.warning(f"{e}, keeping the partial answer")
+            is_interrupted = True
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        answer = self._postprocess_answer(answer)
+        n_input_tokens, n_output_tokens = token_counter.n_input_tokens, token_counter.n_output_tokens
+        n_cached_input_tokens = token_counter.n_cached_input_tokens
+        self._count_prompt_cache_usage(n_input_tokens, n_cached_input_tokens)
 
-        yield "finished", answer, (n_input_tokens, n_output_tokens), n_first_dialog_messages_removed  # sending final answer
+        if cache_key is not None and not is_interrupted:
+            completion_cache.put(cache_key, answer)
+
+        # sending final answer, "interrupted" if a stall cut it off
+        status = "interrupted" if is_interrupted else "finished"
+        yield status, answer, (n_input_tokens, n_output_tokens, n_cached_input_tokens), n_first_dialog_messages_removed
 
     async def send_vision_message(
         self,
         message,
         dialog_messages=[],
         chat_mode="assistant",
-        image_buffer: BytesIO = None,
+        image=None,  # image_utils.PreparedImage
+        on_queue_position=None,
+        dialog_summary=None,  # Database.get_dialog_history
     ):
-        n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if config.models["info"][self.model].get("vision", False):
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-                    r = await self._client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        **OPENAI_COMPLETION_OPTIONS
-                    )
-                    answer = r.choices[0].message.content
-                else:
-                    raise ValueError(f"Unsupported model: {self.model}")
-
-                answer = self._postprocess_answer(answer)
-                n_input_tokens, n_output_tokens = (
-                    r.usage.prompt_tokens,
-                    r.usage.completion_tokens,
-                )
-            except BadRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise ValueError(
-                        "Dialog messages is reduced to zero, but still has too many tokens to make completion"
-                    ) from e
+        if not config.models["info"][self.model].get("vision", False):
+            raise ValueError(f"Unsupported model: {self.model}")
 
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
+        cache_key = self._get_completion_cache_key(
+            message, dialog_messages, chat_mode, image, dialog_summary
+        )
+        answer = self._get_cached_answer(cache_key)
+        if answer is not None:
+            return answer, (0, 0, 0), 0
 
+        n_dialog_messages_before = len(dialog_messages)
+        dialog_messages, _ = self._fit_dialog_messages(
+            message, dialog_messages, chat_mode, image, dialog_summary
+        )
         n_first_dialog_messages_removed = n_dialog_messages_before - len(
             dialog_messages
         )
 
+        dialog_images = await self._load_dialog_images(dialog_messages)
+        messages = self._generate_prompt_messages(
+            message, dialog_messages, chat_mode, image, dialog_images, dialog_summary
+        )
+        _, r, _ = await self._start_hedged(
+            lambda provider, model, on_queue_position: self._create_completion(provider, model, messages, chat_mode, on_queue_position),
+            on_queue_position,
+            hedge=False,
+        )
+        answer = self._postprocess_answer(r.choices[0].message.content)
+        n_input_tokens, n_output_tokens, n_cached_input_tokens = (
+            r.usage.prompt_tokens,
+            r.usage.completion_tokens,
+            get_n_cached_input_tokens(r.usage),
+        )
+        self._count_prompt_cache_usage(n_input_tokens, n_cached_input_tokens)
+
+        if cache_key is not None:
+            completion_cache.put(cache_key, answer)
+
         return (
             answer,
-            (n_input_tokens, n_output_tokens),
+            (n_input_tokens, n_output_tokens, n_cached_input_tokens),
             n_first_dialog_messages_removed,
         )
 
@@ -181,71 +806,337 @@ class ChatGPT:
         message,
         dialog_messages=[],
         chat_mode="assistant",
-        image_buffer: BytesIO = None,
+        image=None,  # image_utils.PreparedImage
+        on_queue_position=None,
+        dialog_summary=None,  # Database.get_dialog_history
     ):
+        if not config.models["info"][self.model].get("vision", False):
+            raise ValueError(f"Unsupported model: {self.model}")
+
+        cache_key = self._get_completion_cache_key(
+            message, dialog_messages, chat_mode, image, dialog_summary
+        )
+        answer = self._get_cached_answer(cache_key)
+        if answer is not None:
+            yield "finished", answer, (0, 0, 0), 0
+            return
+
         n_dialog_messages_before = len(dialog_messages)
-        answer = None
-        while answer is None:
-            try:
-                if config.models["info"][self.model].get("vision", False):
-                    messages = self._generate_prompt_messages(
-                        message, dialog_messages, chat_mode, image_buffer
-                    )
-
-                    r_gen = await self._client.chat.completions.create(
-                        model=self.model,
-                        messages=messages,
-                        stream=True,
-                        **OPENAI_COMPLETION_OPTIONS,
-                    )
-
-                    answer = ""
-                    async for r_item in r_gen:
-                        if len(r_item.choices) == 0:
-                            continue
-                        delta = r_item.choices[0].delta
-                        if delta.content:
-                            answer += delta.content
-                            (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ) = self._count_tokens_from_messages(
-                                messages, answer, model=self.model
-                            )
-                            n_first_dialog_messages_removed = (
-                                n_dialog_messages_before - len(dialog_messages)
-                            )
-                            yield "not_finished", answer, (
-                                n_input_tokens,
-                                n_output_tokens,
-                            ), n_first_dialog_messages_removed
-
-                answer = self._postprocess_answer(answer)
-
-            except BadRequestError as e:  # too many tokens
-                if len(dialog_messages) == 0:
-                    raise e
-                # forget first message in dialog_messages
-                dialog_messages = dialog_messages[1:]
-
-        yield "finished", answer, (
+        dialog_messages, n_input_tokens = self._fit_dialog_messages(
+            message, dialog_messages, chat_mode, image, dialog_summary
+        )
+        n_first_dialog_messages_removed = n_dialog_messages_before - len(
+            dialog_messages
+        )
+
+        dialog_images = await self._load_dialog_images(dialog_messages)
+        messages = self._generate_prompt_messages(
+            message, dialog_messages, chat_mode, image, dialog_images, dialog_summary
+        )
+        token_counter = _StreamTokenCounter(get_encoding(self.model), n_input_tokens)
+        (provider, _), (r_items, start_time), exit_stack = await self._start_hedged(
+            lambda provider, model, on_queue_position: self._open_completion_stream(provider, model, messages, chat_mode, on_queue_position),
+            on_queue_position,
+        )
+        answer = ""
+        is_interrupted = False
+        try:
+            async with exit_stack:
+                async for r_item in r_items:
+                    if r_item.usage is not None:
+                        token_counter.reconcile(r_item.usage)
+                    if len(r_item.choices) == 0:
+                        continue
+                    delta = r_item.choices[0].delta
+                    if delta.content:
+                        token_counter.add(delta.content)
+                        answer = token_counter.text
+                        n_input_tokens, n_output_tokens, n_cached_input_tokens = (
+                            token_counter.n_input_tokens,
+                            token_counter.n_output_tokens,
+                            token_counter.n_cached_input_tokens,
+                        )
+                        yield "not_finished", answer, (
+                            n_input_tokens,
+                            n_output_tokens,
+                            n_cached_input_tokens,
+                        ), n_first_dialog_messages_removed
+
+                self._get_metric(metrics.CHATGPT_COMPLETION_DURATION, chat_mode, provider).observe(time.perf_counter() - start_time)
+        except StreamStalledError as e:
+            logger.warning(f"{e}, keeping the partial answer")
+            is_interrupted = True
+
+        answer = self._postprocess_answer(answer)
+        n_input_tokens, n_output_tokens, n_cached_input_tokens = (
+            token_counter.n_input_tokens,
+            token_counter.n_output_tokens,
+            token_counter.n_cached_input_tokens,
+        )
+        self._count_prompt_cache_usage(n_input_tokens, n_cached_input_tokens)
+
+        if cache_key is not None and not is_interrupted:
+            completion_cache.put(cache_key, answer)
+
+        yield "interrupted" if is_interrupted else "finished", answer, (
             n_input_tokens,
             n_output_tokens,
+            n_cached_input_tokens,
         ), n_first_dialog_messages_removed
 
-    def _encode_image(self, image_buffer: BytesIO) -> bytes:
-        return base64.b64encode(image_buffer.read()).decode("utf-8")
+    async def summarize_dialog(self, dialog_messages, previous_summary=None):
+        """Folds dialog_messages into the previous summary text of their dialog (see compaction.py).
+
+        Images are left out. Returns the new summary text and
+        (n_input_tokens, n_output_tokens, n_cached_input_tokens).
+        """
+        turns = "\n\n".join(
+            f"User: {get_dialog_message_text(dialog_message['user'])}\nAssistant: {dialog_message['bot']}"
+            for dialog_message in dialog_messages
+        )
+        messages = [
+            {"role": "system", "content": DIALOG_SUMMARY_PROMPT},
+            {"role": "user", "content": f"Previous summary:\n{previous_summary or '(none)'}\n\nNew turns:\n{turns}"},
+        ]
+        _, r, _ = await self._start_hedged(
+            lambda provider, model, on_queue_position: self._create_completion(provider, model, messages, "dialog_summary", on_queue_position),
+            hedge=False,
+        )
+        answer = self._postprocess_answer(r.choices[0].message.content)
+        return answer, (r.usage.prompt_tokens, r.usage.completion_tokens, get_n_cached_input_tokens(r.usage))
+
+    def _get_metric(self, histogram, chat_mode, provider):
+        return histogram.labels(model=self.model, provider=provider, chat_mode=chat_mode)
+
+    async def _start_hedged(self, start_attempt, on_queue_position=None, hedge=True):
+        """Runs `start_attempt(provider, model, on_queue_position)` on the model's routes until one succeeds.
+
+        The first route starts at once. The next one starts when no attempt has
+        succeeded within the hedge delay (a hedged request), or right away when
+        an attempt fails with one of FAILOVER_ERRORS. The first attempt to
+        succeed wins and the others are cancelled. Attempts return
+        (result, exit_stack); returns (route, result, exit_stack) of the winner.
+
+        With `hedge=False` the next route starts only on failure: a non-streamed
+        attempt succeeds only after the whole answer is generated, so the hedge
+        delay would fire a second paid request for nearly every slow answer.
+        """
+        hedge_delay = get_hedge_delay(self.model) if hedge else None
+        attempts = {}  # task -> route
+        i_next_route = 0
+        error = None
+        try:
+            while True:
+                if i_next_route < len(self.routes):
+                    provider, model = self.routes[i_next_route]
+                    if i_next_route > 0:
+                        logger.info(f"{'Failing over' if error is not None else 'Hedging'} {self.model} request to {provider}")
+                    # only the first route reports queue positions to the user
+                    attempt = start_attempt(provider, model, on_queue_position if i_next_route == 0 else None)
+                    attempts[asyncio.create_task(attempt)] = (provider, model)
+                    i_next_route += 1
+                elif not attempts:
+                    raise error
+
+                timeout = hedge_delay if i_next_route < len(self.routes) else None
+                done, _ = await asyncio.wait(attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+
+                # successes first, so a failure next to a winner is not raised
+                winner = None
+                for task in sorted(done, key=lambda task: task.exception() is not None):
+                    route = attempts.pop(task)
+                    if task.exception() is not None:
+                        self._count_attempt(route, "failed")
+                        error = task.exception()
+                        # an open breaker is already logged when it opens
+                        log = logger.debug if isinstance(error, ProviderUnavailableError) else logger.warning
+                        log(f"{self.model} request through {route[0]} failed: {error!r}")
+                        if winner is None and not isinstance(error, FAILOVER_ERRORS):
+                            raise error
+                    elif winner is None:
+                        self._count_attempt(route, "won")
+                        winner = (route, *task.result())
+                    else:  # finished at the same time as the winner
+                        self._count_attempt(route, "cancelled")
+                        await task.result()[1].aclose()
+
+                if winner is not None:
+                    return winner
+        finally:
+            for task in attempts:
+                task.cancel()
+            results = await asyncio.gather(*attempts, return_exceptions=True)
+            for route, result in zip(attempts.values(), results):
+                if isinstance(result, tuple):  # succeeded before it could be cancelled
+                    await result[1].aclose()
+                self._count_attempt(route, "cancelled")
+
+    def _count_prompt_cache_usage(self, n_input_tokens, n_cached_input_tokens):
+        metrics.CHATGPT_INPUT_TOKENS.labels(model=self.model, cache="hit").inc(n_cached_input_tokens)
+        metrics.CHATGPT_INPUT_TOKENS.labels(model=self.model, cache="miss").inc(max(0, n_input_tokens - n_cached_input_tokens))
+
+    def _count_attempt(self, route, outcome):
+        metrics.UPSTREAM_ROUTE_ATTEMPTS.labels(model=self.model, provider=route[0], outcome=outcome).inc()
+
+    async def _create_completion(self, provider, model, messages, chat_mode, on_queue_position=None):
+        provider_health = get_provider_health(provider)
+        with provider_health.request():
+            async with upstream_scheduler.slot(provider, model, self.user_id, on_queue_position):
+                start_time = time.perf_counter()
+                r = await _get_client(provider).chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    **OPENAI_COMPLETION_OPTIONS
+                )
+                # the whole generation, not a time to first token: only streams feed the provider's TTFT
+                self._get_metric(metrics.CHATGPT_COMPLETION_DURATION, chat_mode, provider).observe(time.perf_counter() - start_time)
+        return r, contextlib.AsyncExitStack()
+
+    async def _open_completion_stream(self, provider, model, messages, chat_mode, on_queue_position=None):
+        """Starts a streamed completion and reads it up to the first content token.
+
+        Returns the stream's chunks (the ones already read first) and its start
+        time; the exit stack holds the request slot and closes the stream. The
+        provider's outcome is recorded when the exit stack closes, so a stream
+        that stalls after its first token counts as one failure.
+        """
+        provider_health = get_provider_health(provider)
+        exit_stack = contextlib.AsyncExitStack()
+        try:
+            exit_stack.enter_context(provider_health.request())
+            await exit_stack.enter_async_context(upstream_scheduler.slot(provider, model, self.user_id, on_queue_position))
+            start_time = time.perf_counter()
+            r_gen = await _get_client(provider).chat.completions.create(
+                model=model,
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                **OPENAI_COMPLETION_OPTIONS
+            )
+            exit_stack.push_async_callback(r_gen.close)
+
+            r_iter = _watch_stalls(aiter(r_gen), config.stream_stall_timeout, provider)
+            first_items = []
+            async for r_item in r_iter:
+                first_items.append(r_item)
+                if r_item.choices and r_item.choices[0].delta.content:
+                    time_to_first_token = time.perf_counter() - start_time
+                    self._get_metric(metrics.CHATGPT_TIME_TO_FIRST_TOKEN, chat_mode, provider).observe(time_to_first_token)
+                    provider_health.record_time_to_first_token(time_to_first_token)
+                    break
+        except BaseException as e:
+            await exit_stack.__aexit__(type(e), e, e.__traceback__)
+            raise
+
+        return (_resume_stream(first_items, r_iter), start_time), exit_stack
+
+    def _get_completion_cache_key(self, message, dialog_messages, chat_mode, image=None, dialog_summary=None):
+        """Cache key for first-turn text messages in chat modes with enable_completion_cache, else None"""
+        if completion_cache.max_size == 0 or not config.chat_modes[chat_mode].get("enable_completion_cache", False):
+            return None
+
+        if len(dialog_messages) > 0 or image is not None or dialog_summary is not None:
+            return None
+
+        return CompletionCache.get_key(self.model, chat_mode, message, OPENAI_COMPLETION_OPTIONS)
+
+    def _get_cached_answer(self, cache_key):
+        if cache_key is None:
+            return None
 
-    def _generate_prompt_messages(self, message, dialog_messages, chat_mode, image_buffer: BytesIO = None):
+        answer = completion_cache.get(cache_key)
+        metrics.COMPLETION_CACHE_LOOKUPS.labels(model=self.model, result="hit" if answer is not None else "miss").inc()
+        return answer
+
+    def _fit_dialog_messages(self, message, dialog_messages, chat_mode, image=None, dialog_summary=None):
+        """Picks the longest suffix of dialog_messages that fits into the model's context window.
+
+        Uses the token counts cached on dialog messages, so nothing is sent to the
+        provider just to find out that the prompt is too long. Images of older turns
+        are kept only while the budget allows it, otherwise just their text is sent.
+        The dialog summary, if any, is always sent.
+        Returns the kept dialog messages and the estimated number of prompt tokens.
+        """
+        supports_vision = config.models["info"][self.model].get("vision", False)
+
+        encoding = get_encoding(self.model)
+
+        n_input_tokens = count_system_prompt_tokens(chat_mode, self.model)
+        if dialog_summary is not None:
+            n_input_tokens += dialog_summary["n_tokens"]
+        n_input_tokens += TOKENS_PER_MESSAGE + len(encoding.encode(message))
+        if image is not None:
+            n_input_tokens += estimate_image_tokens(image.width, image.height, image.detail)
+        n_input_tokens += TOKENS_PER_REPLY
+
+        context_window = config.models["info"][self.model].get("context_window")
+        if context_window is None:
+            n_tokens_budget = math.inf
+        else:
+            n_tokens_budget = int(context_window * CONTEXT_WINDOW_USAGE) - OPENAI_COMPLETION_OPTIONS["max_tokens"]
+
+        if n_input_tokens > n_tokens_budget:
+            raise ValueError("Message has too many tokens to make completion")
+
+        kept_dialog_messages = []
+        for dialog_message in reversed(dialog_messages):
+            n_tokens = dialog_message.get("n_tokens")
+            if n_tokens is None:  # messages stored before token counts were cached
+                n_tokens = count_dialog_message_tokens(dialog_message, self.model)
+
+            n_image_tokens = _count_image_tokens(dialog_message["user"])
+            if n_image_tokens > 0 and (not supports_vision or n_input_tokens + n_tokens > n_tokens_budget):
+                dialog_message = _strip_images(dialog_message)
+                n_tokens -= n_image_tokens
+
+            if n_input_tokens + n_tokens > n_tokens_budget:
+                break
+
+            n_input_tokens += n_tokens
+            kept_dialog_messages.append(dialog_message)
+
+        return kept_dialog_messages[::-1], n_input_tokens
+
+    async def _load_dialog_images(self, dialog_messages):
+        """Fetches images referenced by dialog messages, returns {image_id: base64 string}"""
+        image_ids = {
+            part["image_id"]
+            for dialog_message in dialog_messages if isinstance(dialog_message["user"], list)
+            for part in dialog_message["user"] if part["type"] == "image" and "image_id" in part
+        }
+        if len(image_ids) == 0:
+            return {}
+
+        image_ids = list(image_ids)
+        images = await asyncio.gather(*(self._blob_store.get(image_id) for image_id in image_ids))
+        return {
+            image_id: base64.b64encode(image).decode("utf-8")
+            for image_id, image in zip(image_ids, images)
+        }
+
+    def _generate_prompt_messages(
+        self, message, dialog_messages, chat_mode, image=None, dialog_images: dict = None, dialog_summary: dict = None
+    ):
         prompt = config.chat_modes[chat_mode]["prompt_start"]
 
-        messages = [{"role": "system", "content": prompt}]
+        if dialog_summary is not None:
+            # stands in for the dialog messages it covers; it goes after the prompt,
+            # so a new summary leaves the cached prompt prefix intact
+            messages = [{"role": "system", "content": [
+                {"type": "text", "text": prompt},
+                {"type": "text", "text": get_dialog_summary_text(dialog_summary["text"])},
+            ]}]
+        else:
+            messages = [{"role": "system", "content": prompt}]
 
         for dialog_message in dialog_messages:
-            messages.append({"role": "user", "content": dialog_message["user"]})
+            messages.append({
+                "role": "user",
+                "content": self._generate_dialog_user_content(dialog_message["user"], dialog_images or {})
+            })
             messages.append({"role": "assistant", "content": dialog_message["bot"]})
 
-        if image_buffer is not None:
+        if image is not None:
             messages.append(
                 {
                     "role": "user",
@@ -258,8 +1149,8 @@ class ChatGPT:
                             "type": "image_url",
                             "image_url" : {
 
-                                "url": f"data:image/jpeg;base64,{self._encode_image(image_buffer)}",
-                                "detail":"high"
+                                "url": f"data:image/jpeg;base64,{image.base64}",
+                                "detail": image.detail
                             }
                         }
                     ]
@@ -269,61 +1160,60 @@ class ChatGPT:
         else:
             messages.append({"role": "user", "content": message})
 
+        if config.models["info"][self.model].get("cache_control", False):
+            _add_cache_breakpoints(messages)
+
         return messages
 
-    def _postprocess_answer(self, answer):
-        answer = answer.strip()
-        return answer
+    def _generate_dialog_user_content(self, content, dialog_images):
+        # stored images are converted to the API's image_url parts
+        if not isinstance(content, list):
+            return content
 
-    def _count_tokens_from_messages(self, messages, answer, model="gpt-3.5-turbo"):
-        try:
-            encoding = tiktoken.encoding_for_model(model)
-        except KeyError:
-            # models not known to tiktoken (e.g. Claude or other models routed
-            # via OpenRouter) fall back to a modern encoding for an estimate
-            encoding = tiktoken.get_encoding("o200k_base")
-
-        # all currently supported chat models (gpt-4o, gpt-4o-mini, gpt-5.5,
-        # Claude, ...) use the same per-message overhead
-        tokens_per_message = 3
-        tokens_per_name = 1
-
-        # input
-        n_input_tokens = 0
-        for message in messages:
-            n_input_tokens += tokens_per_message
-            if isinstance(message["content"], list):
-                for sub_message in message["content"]:
-                    if "type" in sub_message:
-                        if sub_message["type"] == "text":
-                            n_input_tokens += len(encoding.encode(sub_message["text"]))
-                        elif sub_message["type"] == "image_url":
-                            pass
+        api_content = []
+        for part in content:
+            if part["type"] == "image":
+                # older messages embed the image itself instead of a blob reference
+                image = dialog_images[part["image_id"]] if "image_id" in part else part["image"]
+                api_content.append({
+                    "type": "image_url",
+                    "image_url": {"url": f"data:image/jpeg;base64,{image}", "detail": part.get("detail", "high")}
+                })
             else:
-                if "type" in message:
-                    if message["type"] == "text":
-                        n_input_tokens += len(encoding.encode(message["text"]))
-                    elif message["type"] == "image_url":
-                        pass
-
-
-        n_input_tokens += 2
+                api_content.append(part)
 
-        # output
-        n_output_tokens = 1 + len(encoding.encode(answer))
+        return api_content
 
-        return n_input_tokens, n_output_tokens
+    def _postprocess_answer(self, answer):
+        answer = answer.strip()
+        return answer
 
 
+@metrics.timed(metrics.TRANSCRIBE_AUDIO_DURATION)
 async def transcribe_audio(audio_file) -> str:
     r = await openai_client.audio.transcriptions.create(model="whisper-1", file=audio_file)
     return r.text or ""
 
 
-async def generate_images(prompt, n_images=1, size="1024x1024"):
+async def _generate_image(prompt, size):
     # gpt-image-1 returns base64-encoded images (no URLs), so decode to bytes
     r = await openai_client.images.generate(
-        model="gpt-image-1", prompt=prompt, n=n_images, size=size
+        model="gpt-image-1", prompt=prompt, n=1, size=size
     )
-    images = [base64.b64decode(item.b64_json) for item in r.data]
-    return images
+    return base64.b64decode(r.data[0].b64_json)
+
+
+@metrics.timed(metrics.GENERATE_IMAGES_DURATION)
+async def generate_images(prompt, n_images=1, size="1024x1024"):
+    """Generates `n_images` images with one concurrent request each.
+
+    A request with n > 1 renders its images one after another and returns
+    them all at the end, so separate requests finish in about the time of one
+    image. If any of them fails, the rest are cancelled.
+    """
+    tasks = [asyncio.create_task(_generate_image(prompt, size)) for _ in range(n_images)]
+    try:
+        return await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
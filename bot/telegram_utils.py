@@ -0,0 +1,178 @@
+import asyncio
+import time
+
+import telegram
+
+import metrics
+
+
+class _TokenBucket:
+    def __init__(self, rate: float):
+        self.rate = rate
+        self.capacity = max(rate, 1.0)
+
+        self._n_tokens = self.capacity
+        self._updated_time = time.monotonic()
+        self._lock = asyncio.Lock()  # waiters are served in FIFO order
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._n_tokens = min(self.capacity, self._n_tokens + (now - self._updated_time) * self.rate)
+                self._updated_time = now
+
+                if self._n_tokens >= 1:
+                    self._n_tokens -= 1
+                    return
+
+                await asyncio.sleep((1 - self._n_tokens) / self.rate)
+
+
+class EditScheduler:
+    """Rate limits shared by all streamed answers of the bot.
+
+    Each chat gets at most one edit per `private_chat_interval` (or `group_chat_interval`,
+    Telegram is stricter for groups) seconds, and all chats together stay within
+    `max_edits_per_second`.
+    """
+
+    def __init__(
+        self,
+        private_chat_interval: float = 1.0,
+        group_chat_interval: float = 3.0,
+        min_chars: int = 20,
+        max_edits_per_second: float = 25.0,
+    ):
+        self.private_chat_interval = private_chat_interval
+        self.group_chat_interval = group_chat_interval
+        self.min_chars = min_chars
+
+        self._bucket = _TokenBucket(max_edits_per_second)
+        self._last_edit_time = {}  # chat_id -> time of the last (reserved) edit
+        self._n_active_streams = {}  # chat_id -> number of streams being edited
+
+    def open_stream(self, chat_id: int):
+        self._n_active_streams[chat_id] = self._n_active_streams.get(chat_id, 0) + 1
+
+    def close_stream(self, chat_id: int):
+        self._n_active_streams[chat_id] -= 1
+        if self._n_active_streams[chat_id] == 0:
+            del self._n_active_streams[chat_id]
+            self._last_edit_time.pop(chat_id, None)
+
+    async def wait_for_slot(self, chat_id: int, is_group_chat: bool):
+        start_time = time.perf_counter()
+        interval = self.group_chat_interval if is_group_chat else self.private_chat_interval
+        while True:
+            delay = self._last_edit_time.get(chat_id, -interval) + interval - time.monotonic()
+            if delay <= 0:
+                break
+            await asyncio.sleep(delay)
+
+        # reserve the slot before awaiting the global budget, so that other
+        # streams in the same chat keep waiting
+        self._last_edit_time[chat_id] = time.monotonic()
+        await self._bucket.acquire()
+
+        metrics.QUEUE_WAIT_DURATION.labels(queue="telegram_edit").observe(time.perf_counter() - start_time)
+
+
+class StreamedMessageEditor:
+    """Keeps a placeholder message in sync with a streamed answer.
+
+    `update()` never blocks: a background task edits the message whenever the
+    scheduler grants a slot, always with the newest text, so intermediate texts
+    that became stale while waiting are skipped.
+    """
+
+    def __init__(
+        self,
+        scheduler: EditScheduler,
+        bot: telegram.Bot,
+        message: telegram.Message,
+        parse_mode=None,
+        is_group_chat: bool = False,
+    ):
+        self._scheduler = scheduler
+        self._bot = bot
+        self._message = message
+        self._parse_mode = parse_mode
+        self._is_group_chat = is_group_chat
+
+        self._text = ""
+        self._sent_text = ""
+        self._is_status = False  # the message shows a status, the first answer text replaces it right away
+        self._is_final = False
+        self._has_update = asyncio.Event()
+        self._task = None
+
+    async def __aenter__(self):
+        self._scheduler.open_stream(self._message.chat_id)
+        self._task = asyncio.create_task(self._run())
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        self._task.cancel()
+        await asyncio.gather(self._task, return_exceptions=True)
+        self._scheduler.close_stream(self._message.chat_id)
+
+    def update(self, text: str):
+        self._text = text
+
+        n_new_chars = abs(len(text) - len(self._sent_text))
+        if self._sent_text == "" or self._is_status or n_new_chars >= self._scheduler.min_chars:
+            self._is_status = False
+            self._has_update.set()
+
+    def show_status(self, text: str):
+        """Shows a status (e.g. the queue position) until the answer starts"""
+        self._text = text
+        self._is_status = True
+        self._has_update.set()
+
+    async def finish(self, text: str):
+        """Sends the final text and waits until it is delivered"""
+        self._text = text
+        self._is_final = True
+        self._has_update.set()
+
+        await self._task
+
+    async def _run(self):
+        while True:
+            await self._has_update.wait()
+            await self._scheduler.wait_for_slot(self._message.chat_id, self._is_group_chat)
+            self._has_update.clear()
+
+            text, is_final = self._text, self._is_final
+            if text != self._sent_text:
+                await self._edit(text)
+                self._sent_text = text
+
+            if is_final:
+                return
+
+    async def _edit(self, text: str):
+        chat_type = "group" if self._is_group_chat else "private"
+        with metrics.TELEGRAM_EDIT_DURATION.labels(chat_type=chat_type).time():
+            await self._edit_message_text(text)
+
+    async def _edit_message_text(self, text: str):
+        try:
+            await self._bot.edit_message_text(
+                text,
+                chat_id=self._message.chat_id,
+                message_id=self._message.message_id,
+                parse_mode=self._parse_mode,
+            )
+        except telegram.error.BadRequest as e:
+            if str(e).startswith("Message is not modified"):
+                return
+
+            # answer has invalid markup for parse_mode, so we send it as plain text
+            await self._bot.edit_message_text(
+                text,
+                chat_id=self._message.chat_id,
+                message_id=self._message.message_id,
+            )
@@ -0,0 +1,65 @@
+"""Runs the bot modules against a throwaway config built from config.example.yml.
+
+bot/config.py reads config.yml at import time, so BOT_CONFIG_DIR is set before
+any test module imports a bot module.
+"""
+import os
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+import pytest
+import yaml
+
+
+ROOT_DIR = Path(__file__).resolve().parent.parent
+
+sys.path.insert(0, str(ROOT_DIR / "bot"))
+
+_config_dir = None
+
+
+def pytest_configure(config):
+    global _config_dir
+    _config_dir = Path(tempfile.mkdtemp(prefix="bot-test-config-"))
+
+    for filename in ("models.yml", "chat_modes.yml"):
+        shutil.copy(ROOT_DIR / "config" / filename, _config_dir / filename)
+
+    with open(ROOT_DIR / "config" / "config.example.yml") as f:
+        config_yaml = yaml.safe_load(f)
+    config_yaml.update({
+        "telegram_token": "test",
+        "openai_api_key": "test",
+        "mongodb_backend": "memory",
+        "metrics_port": None,
+    })
+    with open(_config_dir / "config.yml", "w") as f:
+        yaml.safe_dump(config_yaml, f)
+
+    with open(_config_dir / "config.env", "w") as f:
+        f.write("MONGODB_PORT=27017\n")
+
+    os.environ["BOT_CONFIG_DIR"] = str(_config_dir)
+
+
+def pytest_unconfigure(config):
+    if _config_dir is not None:
+        shutil.rmtree(_config_dir, ignore_errors=True)
+
+
+class StubEncoding:
+    """Whitespace tokenizer standing in for tiktoken, which downloads its encodings on first use"""
+
+    name = "stub"
+
+    def encode(self, text, **kwargs):
+        return text.split()
+
+
+@pytest.fixture
+def stub_encoding(monkeypatch):
+    import openai_utils
+
+    monkeypatch.setattr(openai_utils, "get_encoding", lambda model: StubEncoding())
@@ -0,0 +1,29 @@
+import asyncio
+
+import audio_utils
+import config
+
+
+async def fail_to_encode_chunk(audio_data, start, end=None, transcode=True):
+    raise RuntimeError("ffmpeg failed: simulated")
+
+
+async def transcribe_audio(audio_file):
+    return f"transcript of {audio_file.name}"
+
+
+async def detect_no_silences(audio_data):
+    return []
+
+
+def test_failed_chunk_encoding_falls_back_to_one_piece(monkeypatch):
+    monkeypatch.setattr(audio_utils, "HAS_FFMPEG", True)
+    monkeypatch.setattr(audio_utils, "detect_silences", detect_no_silences)
+    monkeypatch.setattr(audio_utils, "encode_chunk", fail_to_encode_chunk)
+    monkeypatch.setattr(audio_utils.openai_utils, "transcribe_audio", transcribe_audio)
+
+    async def run():
+        duration = 3 * config.voice_chunk_duration
+        return [text async for text in audio_utils.transcribe_voice(b"voice", duration, "audio/ogg")]
+
+    assert asyncio.run(run()) == ["transcript of voice.oga"]
@@ -0,0 +1,113 @@
+import asyncio
+from datetime import datetime, timedelta
+from io import BytesIO
+from types import SimpleNamespace
+
+from PIL import Image
+
+import bot
+import config
+
+
+class FakeChatGPT:
+    requests = []  # (message, image) of every request
+
+    def __init__(self, model, **kwargs):
+        self.model = model
+
+    async def send_message_stream(self, message, image=None, **kwargs):
+        self.requests.append((message, image))
+        await asyncio.sleep(0.01)
+        yield "finished", f"Answer to {message}", (1, 1, 0), 0
+
+    send_vision_message_stream = send_message_stream
+
+
+class FakeBot:
+    id = 1
+    username = "test_bot"
+
+    async def edit_message_text(self, text, **kwargs):
+        pass
+
+
+def create_update(user_id, text, replies):
+    async def reply_text(text, **kwargs):
+        replies.append(text)
+        return SimpleNamespace(chat_id=user_id, message_id=len(replies))
+
+    async def send_action(**kwargs):
+        pass
+
+    user = SimpleNamespace(id=user_id, username="user", first_name="User", last_name=None)
+    message = SimpleNamespace(
+        text=text,
+        from_user=user,
+        chat_id=user_id,
+        chat=SimpleNamespace(type="private", send_action=send_action),
+        photo=(),
+        reply_to_message=None,
+        reply_text=reply_text,
+    )
+    return SimpleNamespace(message=message, edited_message=None, effective_user=user)
+
+
+def test_update_waiting_for_lock_reads_previous_update(monkeypatch, stub_encoding):
+    user_id = 1001
+    monkeypatch.setattr(bot.openai_utils, "ChatGPT", FakeChatGPT)
+    monkeypatch.setattr(config, "enable_message_streaming", True)
+    # both updates of an album pass this check before either takes the lock
+    monkeypatch.setattr(bot.user_locks, "is_locked", lambda user_id: asyncio.sleep(0, result=False))
+
+    async def run():
+        await bot.db.add_new_user(user_id, user_id)
+        await bot.db.start_new_dialog(user_id)
+        await bot.db.append_dialog_message(user_id, {"user": [{"type": "text", "text": "Old"}], "bot": "Old answer", "date": datetime.now()})
+        await bot.db.set_user_attribute(user_id, "last_interaction", datetime.now() - timedelta(seconds=config.new_dialog_timeout + 60))
+
+        replies = []
+        context = SimpleNamespace(bot=FakeBot())
+        await asyncio.gather(
+            bot.message_handle(create_update(user_id, "A", replies), context),
+            bot.message_handle(create_update(user_id, "B", replies), context),
+        )
+
+        _, dialog_messages = await bot.db.get_dialog_history(user_id)
+        return replies, dialog_messages
+
+    replies, dialog_messages = asyncio.run(run())
+
+    assert sum(reply.startswith("Starting new dialog due to timeout") for reply in replies) == 1
+    assert [dialog_message["user"][0]["text"] for dialog_message in dialog_messages] == ["A", "B"]
+
+
+def test_retry_of_vision_turn_resends_its_image(monkeypatch, stub_encoding):
+    user_id = 1002
+    monkeypatch.setattr(bot.openai_utils, "ChatGPT", FakeChatGPT)
+    monkeypatch.setattr(FakeChatGPT, "requests", [])
+    monkeypatch.setattr(config, "enable_message_streaming", True)
+
+    buf = BytesIO()
+    Image.new("RGB", (64, 48), "red").save(buf, format="JPEG")
+    image_data = buf.getvalue()
+
+    async def run():
+        await bot.db.add_new_user(user_id, user_id)
+        await bot.db.start_new_dialog(user_id)
+        image_id = await bot.db.blob_store.put(image_data)
+        await bot.db.append_dialog_message(user_id, {
+            "user": [
+                {"type": "text", "text": "What is this?"},
+                {"type": "image", "image_id": image_id, "width": 64, "height": 48, "detail": "high"},
+            ],
+            "bot": "A red square",
+            "date": datetime.now(),
+        })
+
+        await bot.retry_handle(create_update(user_id, "/retry", []), SimpleNamespace(bot=FakeBot()))
+
+    asyncio.run(run())
+
+    [(message, image)] = FakeChatGPT.requests
+    assert message == "What is this?"
+    assert image is not None and (image.data, image.width, image.height) == (image_data, 64, 48)
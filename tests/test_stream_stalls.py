@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+import config
+import openai_utils
+
+
+def create_chunk(content):
+    return SimpleNamespace(usage=None, choices=[SimpleNamespace(delta=SimpleNamespace(content=content))])
+
+
+class StalledStream:
+    """Streamed completion that sends one token and then nothing"""
+
+    def __aiter__(self):
+        return self._items()
+
+    async def _items(self):
+        yield create_chunk("Hello")
+        await asyncio.Event().wait()
+
+    async def close(self):
+        pass
+
+
+class StalledClient:
+    def __init__(self):
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    async def _create(self, **kwargs):
+        return StalledStream()
+
+
+def test_stall_after_first_token_interrupts_answer(monkeypatch, stub_encoding):
+    monkeypatch.setattr(config, "stream_stall_timeout", 0.05)
+    monkeypatch.setattr(openai_utils, "_get_client", lambda provider: StalledClient())
+    monkeypatch.setattr(openai_utils, "_provider_health", {})
+
+    chatgpt_instance = openai_utils.ChatGPT(model="gpt-4o-mini")
+
+    async def run():
+        return [item async for item in chatgpt_instance.send_message_stream("Hi", chat_mode="text_improver")]
+
+    status, answer, _, _ = asyncio.run(run())[-1]
+
+    assert status == "interrupted"
+    assert answer == "Hello"  # the notice is for the user, not part of the dialog
+    # one outcome per request: the stall, not also a success at the first token
+    assert openai_utils.get_provider_health("openai").error_rate == 1.0
+    cache_key = chatgpt_instance._get_completion_cache_key("Hi", [], "text_improver")
+    assert openai_utils.completion_cache.get(cache_key) is None
@@ -0,0 +1,66 @@
+import asyncio
+
+import openai_utils
+
+
+def create_scheduler():
+    return openai_utils.UpstreamScheduler({"openai": 1}, {}, max_queue_size=10)
+
+
+async def hold_slot(scheduler, user_id, acquired, release):
+    async with scheduler.slot("openai", "gpt-4o", user_id=user_id):
+        acquired.set()
+        await release.wait()
+
+
+async def wait_for_slot(scheduler, user_id):
+    async with scheduler.slot("openai", "gpt-4o", user_id=user_id):
+        pass
+
+
+def test_release_racing_cancel_of_waiter():
+    async def run():
+        scheduler = create_scheduler()
+        acquired, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, 1, acquired, release))
+        await acquired.wait()
+
+        waiter = asyncio.create_task(wait_for_slot(scheduler, 2))
+        await asyncio.sleep(0)
+
+        # the holder releases its slot before the cancelled waiter gets to run
+        release.set()
+        waiter.cancel()
+        await holder
+        await asyncio.gather(waiter, return_exceptions=True)
+        assert waiter.cancelled()
+
+        await asyncio.wait_for(wait_for_slot(scheduler, 3), timeout=1.0)
+        assert scheduler._n_running_per_provider["openai"] == 0
+        assert scheduler._n_waiting_per_provider["openai"] == 0
+        assert not scheduler._queues
+
+    asyncio.run(run())
+
+
+def test_cancel_right_after_grant_releases_slot():
+    async def run():
+        scheduler = create_scheduler()
+        acquired, release = asyncio.Event(), asyncio.Event()
+        holder = asyncio.create_task(hold_slot(scheduler, 1, acquired, release))
+        await acquired.wait()
+
+        waiter = asyncio.create_task(wait_for_slot(scheduler, 2))
+        await asyncio.sleep(0)
+
+        # the slot is granted to the waiter, which is cancelled before it resumes
+        release.set()
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(holder, waiter, return_exceptions=True)
+        assert waiter.cancelled()
+
+        await asyncio.wait_for(wait_for_slot(scheduler, 3), timeout=1.0)
+        assert scheduler._n_running_per_provider["openai"] == 0
+
+    asyncio.run(run())
@@ -0,0 +1,83 @@
+import asyncio
+
+import pymongo
+import pytest
+
+import database
+
+
+class FlakyCollection(database._MemoryCollection):
+    """Memory collection whose unordered bulk writes fail for some users, or fail outright"""
+
+    def __init__(self):
+        super().__init__()
+        self.failing_user_ids = set()
+        self.connection_error = False
+
+    async def bulk_write(self, requests: list, ordered: bool = True):
+        if self.connection_error:
+            raise pymongo.errors.AutoReconnect("connection reset")
+
+        write_errors = []
+        for i, request in enumerate(requests):
+            if request._filter["_id"] in self.failing_user_ids:
+                write_errors.append({"index": i, "code": 2, "errmsg": "simulated failure", "op": request._doc})
+            else:
+                await self.update_one(request._filter, request._doc)
+
+        if write_errors:
+            raise pymongo.errors.BulkWriteError({
+                "writeErrors": write_errors,
+                "writeConcernErrors": [],
+                "nInserted": 0,
+                "nUpserted": 0,
+                "nMatched": len(requests) - len(write_errors),
+                "nModified": len(requests) - len(write_errors),
+                "nRemoved": 0,
+                "upserted": [],
+            })
+
+
+def create_ledger(user_ids):
+    collection = FlakyCollection()
+    for user_id in user_ids:
+        asyncio.run(collection.insert_one({"_id": user_id, "n_generated_images": 0}))
+    return collection, database.UsageLedger(collection, flush_interval=1.0)
+
+
+def get_n_generated_images(collection, user_id):
+    return asyncio.run(collection.find_one({"_id": user_id}))["n_generated_images"]
+
+
+def test_partially_failed_flush_retries_only_failed_ops():
+    collection, ledger = create_ledger([1, 2, 3])
+    for user_id in (1, 2, 3):
+        ledger.add(user_id, {"n_generated_images": 1})
+
+    collection.failing_user_ids = {2}
+    with pytest.raises(pymongo.errors.BulkWriteError):
+        asyncio.run(ledger.flush())
+
+    assert ledger.get_pending(1) == {}
+    assert ledger.get_pending(2) == {"n_generated_images": 1}
+    assert ledger.get_pending(3) == {}
+
+    collection.failing_user_ids = set()
+    asyncio.run(ledger.flush())
+
+    assert [get_n_generated_images(collection, user_id) for user_id in (1, 2, 3)] == [1, 1, 1]
+
+
+def test_failed_connection_keeps_all_increments():
+    collection, ledger = create_ledger([1, 2])
+    ledger.add(1, {"n_generated_images": 1})
+    ledger.add(2, {"n_generated_images": 2})
+
+    collection.connection_error = True
+    with pytest.raises(pymongo.errors.AutoReconnect):
+        asyncio.run(ledger.flush())
+
+    collection.connection_error = False
+    asyncio.run(ledger.flush())
+
+    assert [get_n_generated_images(collection, user_id) for user_id in (1, 2)] == [1, 2]